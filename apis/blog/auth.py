@@ -1,36 +1,33 @@
-import requests
-import json
+import os
+import sys
 
-class Authenticate:
+# The shared addon is in /infrastructure/mitmproxy in API images, and in infrastructure/mitmproxy in this repository
+sys.path.extend(['/infrastructure/mitmproxy', os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..', 'infrastructure', 'mitmproxy')])
+from cached_auth import CachedAuthentication
 
-    token = None
+class Authenticate(CachedAuthentication):
 
-    def get_token(self):
+    def get_token(self, session):
         signup_url = "http://localhost:8080/api/auth/signup"
         signin_url = "http://localhost:8080/api/auth/signin"
-        signup_payload = json.dumps({
+        signup_payload = {
             "firstName": "userFirstName",
             "lastName": "userLastName",
             "username": "userUsername",
             "password": "userPassword",
             "email": "user@gmail.com"
-        })
-        headers = {
-            'Content-Type': 'application/json',
-            'Accept': 'application/json'
         }
-        signup_response = requests.request("POST", signup_url, headers=headers, data=signup_payload)
-        signin_payload = json.dumps({
+        # The user already exists when the token is refreshed, so the outcome of the signup is not checked
+        self.post_json(session, signup_url, signup_payload, check=False)
+        signin_payload = {
             "usernameOrEmail": "userUsername",
             "password": "userPassword"
-        })
-        signin_response = requests.request("POST", signin_url, headers=headers, data=signin_payload)
-        self.token = str(signin_response.json()['accessToken'])
-        print(f"Token retrieved: {self.token}")
+        }
+        signin_response = self.post_json(session, signin_url, signin_payload)
+        token = str(signin_response.json()['accessToken'])
+        return token, self.get_jwt_expiry(token)
 
-    def request(self, flow):
-        if self.token == None:
-            self.get_token()
-        flow.request.headers["Authorization"] = "Bearer " + self.token
+    def apply_token(self, flow, token):
+        flow.request.headers["Authorization"] = "Bearer " + token
 
 addons = [Authenticate()]
\ No newline at end of file
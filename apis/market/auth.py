@@ -1,30 +1,25 @@
-import requests
-import json
+import os
+import sys
 
-class Authenticate:
+# The shared addon is in /infrastructure/mitmproxy in API images, and in infrastructure/mitmproxy in this repository
+sys.path.extend(['/infrastructure/mitmproxy', os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..', 'infrastructure', 'mitmproxy')])
+from cached_auth import CachedAuthentication
 
-    token = None
+class Authenticate(CachedAuthentication):
 
-    def get_token(self):
+    def get_token(self, session):
         signup_url = 'http://localhost:8080/register'
-        signup_payload = json.dumps({
+        signup_payload = {
             'email': 'anothertestuser@gmail.com',
             'password': 'testing',
             'phone':'+39 3406089282',
             'address':'address',
             'name':'test'
-        })
-        headers = {
-            'Content-Type': 'application/json',
-            'Accept': 'application/json'
         }
-        signup_response = requests.request('POST', signup_url, headers=headers, data=signup_payload)
-        self.token = str(signup_response.cookies.get_dict()['JSESSIONID'])
-        print(f'Token retrieved: {self.token}')
+        signup_response = self.post_json(session, signup_url, signup_payload, check=False)
+        return str(signup_response.cookies.get_dict()['JSESSIONID'])
 
-    def request(self, flow):
-        if self.token == None:
-            self.get_token()
-        flow.request.headers['Cookie'] = 'JSESSIONID=' + self.token
+    def apply_token(self, flow, token):
+        flow.request.headers['Cookie'] = 'JSESSIONID=' + token
 
 addons = [Authenticate()]
\ No newline at end of file
@@ -0,0 +1,356 @@
+import org.jacoco.cli.internal.core.analysis.Analyzer;
+import org.jacoco.cli.internal.core.analysis.CoverageBuilder;
+import org.jacoco.cli.internal.core.analysis.IBundleCoverage;
+import org.jacoco.cli.internal.core.analysis.IClassCoverage;
+import org.jacoco.cli.internal.core.analysis.ISourceFileCoverage;
+import org.jacoco.cli.internal.core.data.ExecutionData;
+import org.jacoco.cli.internal.core.data.ExecutionDataStore;
+import org.jacoco.cli.internal.core.data.ExecutionDataWriter;
+import org.jacoco.cli.internal.core.data.SessionInfoStore;
+import org.jacoco.cli.internal.core.internal.analysis.BundleCoverageImpl;
+import org.jacoco.cli.internal.core.internal.data.CRC64;
+import org.jacoco.cli.internal.core.runtime.RemoteControlReader;
+import org.jacoco.cli.internal.core.runtime.RemoteControlWriter;
+import org.jacoco.cli.internal.core.tools.ExecFileLoader;
+import org.jacoco.cli.internal.report.IReportVisitor;
+import org.jacoco.cli.internal.report.csv.CSVFormatter;
+
+import java.io.BufferedReader;
+import java.io.ByteArrayInputStream;
+import java.io.ByteArrayOutputStream;
+import java.io.File;
+import java.io.FileInputStream;
+import java.io.FileOutputStream;
+import java.io.IOException;
+import java.io.InputStreamReader;
+import java.io.OutputStream;
+import java.io.OutputStreamWriter;
+import java.io.RandomAccessFile;
+import java.io.Writer;
+import java.net.InetAddress;
+import java.net.Socket;
+import java.nio.charset.StandardCharsets;
+import java.nio.file.Files;
+import java.nio.file.Path;
+import java.nio.file.Paths;
+import java.time.LocalDateTime;
+import java.time.format.DateTimeFormatter;
+import java.util.ArrayList;
+import java.util.Arrays;
+import java.util.Collection;
+import java.util.Collections;
+import java.util.HashSet;
+import java.util.LinkedHashMap;
+import java.util.List;
+import java.util.Map;
+import java.util.Set;
+import java.util.concurrent.ConcurrentHashMap;
+import java.util.concurrent.ExecutorService;
+import java.util.concurrent.Executors;
+import java.util.concurrent.Future;
+import java.util.stream.Collectors;
+import java.util.stream.Stream;
+
+/**
+ * Long-lived code coverage collector. It keeps one JVM and one TCP session with the JaCoCo agent for the whole run,
+ * reads the class files once, and every interval dumps the execution data and computes its coverage report.
+ *
+ * By default, each report analyzes all classes, as the JaCoCo CLI does. With incremental analysis (experimental, not
+ * yet validated against the reports of the JaCoCo CLI), the analysis of each class is kept, and a class is only analyzed
+ * again when its execution data changed since its last analysis, so a report only analyzes the classes exercised since
+ * the previous sample.
+ *
+ * Samples are stored in three files of the output directory, instead of one exec and one CSV file per sample:
+ * - coverage-samples.exec: the exec dumps of all samples, one after the other;
+ * - coverage-samples.idx: one line per sample, with the sample time, offset and length of its dump in the exec file;
+ * - coverage-samples.csv: the JaCoCo CSV report rows (one per class) of all samples, prefixed by the sample time.
+ *
+ * With deferred reports, only the exec dumps are stored during the run, and the reports are generated afterwards by
+ * the report command, in parallel, for every sample that has no report yet.
+ *
+ * The collector stops after its current sample when a coverage-collector.stop file appears in the output directory, and
+ * then removes the file, to tell that it stopped.
+ *
+ * Usage: java -cp org.jacoco.cli-0.8.7-nodeps.jar CoverageCollector.java address port classes-dir output-dir interval-secs [live|deferred] [full|incremental]
+ *        java -cp org.jacoco.cli-0.8.7-nodeps.jar CoverageCollector.java report classes-dir output-dir threads
+ */
+public class CoverageCollector {
+
+    private static final DateTimeFormatter SAMPLE_TIME_FORMAT = DateTimeFormatter.ofPattern("yyyy-MM-dd'T'HH.mm.ss");
+    private static final String EXEC_STORE = "coverage-samples.exec";
+    private static final String INDEX = "coverage-samples.idx";
+    private static final String REPORT_STORE = "coverage-samples.csv";
+    private static final String STOP_FILE = "coverage-collector.stop";
+    private static final String REPORT_HEADER = "SAMPLE_TIME,GROUP,PACKAGE,CLASS,INSTRUCTION_MISSED,INSTRUCTION_COVERED,BRANCH_MISSED,BRANCH_COVERED,LINE_MISSED,LINE_COVERED,COMPLEXITY_MISSED,COMPLEXITY_COVERED,METHOD_MISSED,METHOD_COVERED\n";
+
+    private final String address;
+    private final int port;
+    private final File outputDir;
+    private final List<Path> classFiles;
+    private final List<byte[]> classBytes = new ArrayList<>();
+    private final List<Long> classIds = new ArrayList<>();
+    // Last analysis of each class (by position in classFiles), shared by the report threads
+    private final Map<Integer, AnalyzedClass> analyzedClasses = new ConcurrentHashMap<>();
+
+    private boolean deferReports = false;
+    private boolean incrementalAnalysis = false;
+
+    private Socket socket;
+    private RemoteControlWriter writer;
+    private RemoteControlReader reader;
+
+    public CoverageCollector(String address, int port, Path classesDir, File outputDir) throws IOException {
+        this.address = address;
+        this.port = port;
+        this.outputDir = outputDir;
+        // Class files are read once, instead of being searched and read for every sample
+        try (Stream<Path> paths = Files.walk(classesDir)) {
+            this.classFiles = paths.filter(path -> path.toString().endsWith(".class")).sorted().collect(Collectors.toList());
+        }
+        for (Path classFile : classFiles) {
+            byte[] bytes = Files.readAllBytes(classFile);
+            classBytes.add(bytes);
+            classIds.add(CRC64.classId(bytes));
+        }
+    }
+
+    // Coverage of a class, with the probes of the execution data it was computed from (null if the class had no data)
+    private static class AnalyzedClass {
+
+        private final boolean[] probes;
+        private final Collection<IClassCoverage> coverage;
+
+        private AnalyzedClass(boolean[] probes, Collection<IClassCoverage> coverage) {
+            this.probes = probes;
+            this.coverage = coverage;
+        }
+    }
+
+    // Open the TCP session with the agent, if not open yet
+    private void connect() throws IOException {
+        if (socket == null) {
+            socket = new Socket(InetAddress.getByName(address), port);
+            writer = new RemoteControlWriter(socket.getOutputStream());
+            reader = new RemoteControlReader(socket.getInputStream());
+        }
+    }
+
+    // Close the TCP session, so that the next sample opens a new one
+    private void disconnect() {
+        if (socket != null) {
+            try {
+                socket.close();
+            } catch (IOException e) {
+                // Nothing to do, the session is discarded anyway
+            }
+            socket = null;
+        }
+    }
+
+    public void setDeferReports(boolean deferReports) {
+        this.deferReports = deferReports;
+    }
+
+    public void setIncrementalAnalysis(boolean incrementalAnalysis) {
+        this.incrementalAnalysis = incrementalAnalysis;
+    }
+
+    // Get the coverage of a class with the execution data of a sample, analyzing the class again only if its probes
+    // changed since its last analysis
+    private Collection<IClassCoverage> analyzeClass(int i, ExecutionDataStore executionData) throws IOException {
+        ExecutionData classData = executionData.get(classIds.get(i));
+        boolean[] probes = classData == null ? null : classData.getProbes();
+        AnalyzedClass analyzedClass = analyzedClasses.get(i);
+        if (analyzedClass == null || !Arrays.equals(analyzedClass.probes, probes)) {
+            CoverageBuilder builder = new CoverageBuilder();
+            new Analyzer(executionData, builder).analyzeClass(classBytes.get(i), classFiles.get(i).toString());
+            analyzedClass = new AnalyzedClass(probes == null ? null : probes.clone(), builder.getClasses());
+            analyzedClasses.put(i, analyzedClass);
+        }
+        return analyzedClass.coverage;
+    }
+
+    // Compute the coverage of all classes with the execution data of a sample, reusing the analyses of unchanged classes
+    private IBundleCoverage analyzeIncrementally(ExecutionDataStore executionData) throws IOException {
+        // Classes are merged as a single coverage builder would: a duplicate class is only counted once, and classes with
+        // the same name but different content are rejected
+        Map<String, IClassCoverage> classes = new LinkedHashMap<>();
+        for (int i = 0; i < classBytes.size(); i++) {
+            for (IClassCoverage classCoverage : analyzeClass(i, executionData)) {
+                IClassCoverage duplicate = classes.putIfAbsent(classCoverage.getName(), classCoverage);
+                if (duplicate != null && duplicate.getId() != classCoverage.getId()) {
+                    throw new IllegalStateException("Can't add different class with same name: " + classCoverage.getName());
+                }
+            }
+        }
+        return new BundleCoverageImpl("JaCoCo Coverage Report", classes.values(), Collections.<ISourceFileCoverage>emptyList());
+    }
+
+    // Compute the coverage of all classes with the execution data of a sample, analyzing every class
+    private IBundleCoverage analyze(ExecutionDataStore executionData) throws IOException {
+        CoverageBuilder builder = new CoverageBuilder();
+        Analyzer analyzer = new Analyzer(executionData, builder);
+        for (int i = 0; i < classBytes.size(); i++) {
+            analyzer.analyzeClass(classBytes.get(i), classFiles.get(i).toString());
+        }
+        return builder.getBundle("JaCoCo Coverage Report");
+    }
+
+    // Compute the CSV report rows of a sample, prefixed by the sample time
+    private String report(String sampleTime, SessionInfoStore sessionInfos, ExecutionDataStore executionData) throws IOException {
+        ByteArrayOutputStream csv = new ByteArrayOutputStream();
+        IReportVisitor visitor = new CSVFormatter().createVisitor(csv);
+        visitor.visitInfo(sessionInfos.getInfos(), executionData.getContents());
+        visitor.visitBundle(incrementalAnalysis ? analyzeIncrementally(executionData) : analyze(executionData), null);
+        visitor.visitEnd();
+        StringBuilder rows = new StringBuilder();
+        String[] lines = new String(csv.toByteArray(), StandardCharsets.UTF_8).split("\r?\n");
+        // Skip the header of the JaCoCo report
+        for (int i = 1; i < lines.length; i++) {
+            if (!lines[i].isEmpty()) {
+                rows.append(sampleTime).append(',').append(lines[i]).append('\n');
+            }
+        }
+        return rows.toString();
+    }
+
+    // Append the exec dump of a sample to the exec store, then index it (so that the index never points to partial data)
+    private synchronized void appendExec(String sampleTime, byte[] exec) throws IOException {
+        outputDir.mkdirs();
+        File execStore = new File(outputDir, EXEC_STORE);
+        long offset = execStore.length();
+        try (OutputStream output = new FileOutputStream(execStore, true)) {
+            output.write(exec);
+        }
+        try (Writer index = new OutputStreamWriter(new FileOutputStream(new File(outputDir, INDEX), true), StandardCharsets.UTF_8)) {
+            index.write(sampleTime + " " + offset + " " + exec.length + "\n");
+        }
+    }
+
+    // Append the report rows of a sample to the report store, with a single write
+    private synchronized void appendReport(String rows) throws IOException {
+        outputDir.mkdirs();
+        File reportStore = new File(outputDir, REPORT_STORE);
+        boolean newStore = !reportStore.exists();
+        try (Writer output = new OutputStreamWriter(new FileOutputStream(reportStore, true), StandardCharsets.UTF_8)) {
+            output.write(newStore ? REPORT_HEADER + rows : rows);
+        }
+    }
+
+    // Get the times of the samples that already have a report
+    private Set<String> getReportedSamples() throws IOException {
+        Set<String> sampleTimes = new HashSet<>();
+        File reportStore = new File(outputDir, REPORT_STORE);
+        if (reportStore.exists()) {
+            try (BufferedReader input = new BufferedReader(new InputStreamReader(new FileInputStream(reportStore), StandardCharsets.UTF_8))) {
+                String line;
+                while ((line = input.readLine()) != null) {
+                    sampleTimes.add(line.substring(0, Math.max(line.indexOf(','), 0)));
+                }
+            }
+        }
+        return sampleTimes;
+    }
+
+    // Generate the missing reports from the exec store, using the given number of threads
+    public int reportAll(int threads) throws Exception {
+        File index = new File(outputDir, INDEX);
+        if (!index.exists()) {
+            return 0;
+        }
+        Set<String> reportedSamples = getReportedSamples();
+        ExecutorService executor = Executors.newFixedThreadPool(threads);
+        List<Future<?>> reports = new ArrayList<>();
+        for (String line : Files.readAllLines(index.toPath(), StandardCharsets.UTF_8)) {
+            String[] fields = line.split(" ");
+            if (fields.length != 3 || reportedSamples.contains(fields[0])) {
+                continue;
+            }
+            String sampleTime = fields[0];
+            long offset = Long.parseLong(fields[1]);
+            byte[] exec = new byte[Integer.parseInt(fields[2])];
+            reports.add(executor.submit(() -> {
+                try (RandomAccessFile execStore = new RandomAccessFile(new File(outputDir, EXEC_STORE), "r")) {
+                    execStore.seek(offset);
+                    execStore.readFully(exec);
+                }
+                ExecFileLoader loader = new ExecFileLoader();
+                loader.load(new ByteArrayInputStream(exec));
+                appendReport(report(sampleTime, loader.getSessionInfoStore(), loader.getExecutionDataStore()));
+                return null;
+            }));
+        }
+        executor.shutdown();
+        int failed = 0;
+        for (Future<?> report : reports) {
+            try {
+                report.get();
+            } catch (Exception e) {
+                System.err.println("[WARN] Could not generate coverage report: " + e.getMessage());
+                failed++;
+            }
+        }
+        System.out.println("Generated " + (reports.size() - failed) + "/" + reports.size() + " coverage reports.");
+        return failed;
+    }
+
+    // Dump execution data from the agent and store it with, unless deferred, its report
+    private void sample(String sampleTime) throws IOException {
+        ExecutionDataStore executionData = new ExecutionDataStore();
+        SessionInfoStore sessionInfos = new SessionInfoStore();
+        reader.setSessionInfoVisitor(sessionInfos);
+        reader.setExecutionDataVisitor(executionData);
+        writer.visitDumpCommand(true, false);
+        if (!reader.read()) {
+            throw new IOException("Session with the JaCoCo agent closed unexpectedly.");
+        }
+
+        ByteArrayOutputStream exec = new ByteArrayOutputStream();
+        ExecutionDataWriter execWriter = new ExecutionDataWriter(exec);
+        sessionInfos.accept(execWriter);
+        executionData.accept(execWriter);
+        appendExec(sampleTime, exec.toByteArray());
+
+        if (!deferReports) {
+            appendReport(report(sampleTime, sessionInfos, executionData));
+        }
+    }
+
+    // Take a sample every interval, until the stop file appears. Samples never overlap: if one takes longer than the
+    // interval, the missed ticks are skipped
+    public void run(long intervalMillis) throws InterruptedException {
+        File stopFile = new File(outputDir, STOP_FILE);
+        long nextTick = System.currentTimeMillis();
+        while (!stopFile.exists()) {
+            String sampleTime = LocalDateTime.now().format(SAMPLE_TIME_FORMAT);
+            try {
+                connect();
+                sample(sampleTime);
+            } catch (IOException e) {
+                System.err.println("[WARN] Could not collect coverage sample " + sampleTime + ": " + e.getMessage());
+                disconnect();
+            }
+            nextTick += intervalMillis;
+            long now = System.currentTimeMillis();
+            if (now > nextTick) {
+                long missedTicks = (now - nextTick) / intervalMillis + 1;
+                System.err.println("[WARN] Coverage sample " + sampleTime + " took longer than the interval. Skipping " + missedTicks + " sample(s).");
+                nextTick += missedTicks * intervalMillis;
+            }
+            Thread.sleep(nextTick - now);
+        }
+        disconnect();
+        stopFile.delete();
+    }
+
+    public static void main(String[] args) throws Exception {
+        if (args[0].equals("report")) {
+            CoverageCollector collector = new CoverageCollector(null, 0, Paths.get(args[1]), new File(args[2]));
+            System.exit(collector.reportAll(Integer.parseInt(args[3])) == 0 ? 0 : 1);
+        }
+        CoverageCollector collector = new CoverageCollector(args[0], Integer.parseInt(args[1]), Paths.get(args[2]), new File(args[3]));
+        collector.setDeferReports(args.length > 5 && args[5].equals("deferred"));
+        collector.setIncrementalAnalysis(args.length > 6 && args[6].equals("incremental"));
+        collector.run(Long.parseLong(args[4]) * 1000);
+    }
+}
@@ -1,2 +1,13 @@
 sleep 10
-while true ; do sh /infrastructure/jacoco/collect-coverage.sh & sleep 5; done
\ No newline at end of file
+# Long-lived collector: one JVM and one session with the JaCoCo agent for the whole run, a sample every 5 seconds
+# (with COVERAGE_REPORTS=deferred, only exec files are written during the run, and CSV reports are generated afterwards).
+# COVERAGE_ANALYSIS=incremental enables the experimental reuse of unchanged class analyses across samples
+java -cp /infrastructure/jacoco/org.jacoco.cli-0.8.7-nodeps.jar /infrastructure/jacoco/CoverageCollector.java localhost 12345 /api/classes/ /results/$API/$TOOL/$RUN/code-coverage 5 ${COVERAGE_REPORTS:-live} ${COVERAGE_ANALYSIS:-full}
+# The collector exits successfully when it is stopped through the stop file (before deferred reports are generated).
+# Otherwise, fall back to launching the JaCoCo CLI for each sample, e.g., if the image has no JDK compiler
+if [ $? -ne 0 ]; then
+    stop_file=/results/$API/$TOOL/$RUN/code-coverage/coverage-collector.stop
+    while [ ! -f $stop_file ] ; do sh /infrastructure/jacoco/collect-coverage.sh & sleep 5; done
+    wait
+    rm -f $stop_file
+fi
@@ -0,0 +1,108 @@
+import abc
+import asyncio
+import base64
+import concurrent.futures
+import json
+import time
+import requests
+
+# Base of the authentication addons of APIs, which only implement get_token and apply_token
+class CachedAuthentication(abc.ABC):
+
+    # Tokens are kept for TOKEN_TTL seconds (None: until the proxy stops), unless the subclass tells their expiry, and
+    # are refreshed in the background REFRESH_MARGIN seconds before they expire, while flows keep using the current one
+    TOKEN_TTL = None
+    REFRESH_MARGIN = 60
+
+    # Each HTTP call of a fetch times out after FETCH_TIMEOUT seconds. After a failed fetch, the next one is only tried
+    # after a backoff (doubling from RETRY_BACKOFF_MIN up to RETRY_BACKOFF_MAX seconds), and flows meanwhile go through
+    # with the last token, if any, instead of retrying the login each
+    FETCH_TIMEOUT = 10
+    RETRY_BACKOFF_MIN = 1
+    RETRY_BACKOFF_MAX = 60
+
+    token = None
+    expires_at = None
+
+    def __init__(self):
+        # Login calls go straight to the API with a pooled session, in a thread, so that the proxy loop never waits for them
+        self.session = requests.Session()
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=1, thread_name_prefix='auth')
+        self.fetch = None
+        self.failures = 0
+        self.retry_at = 0
+
+    # Retrieve a new token from the API with the session. Returns the token, or a (token, expiry timestamp) tuple
+    @abc.abstractmethod
+    def get_token(self, session):
+        pass
+
+    # Add the token to a request
+    @abc.abstractmethod
+    def apply_token(self, flow, token):
+        pass
+
+    # POST a JSON payload to the API, failing on timeout or on error status codes
+    def post_json(self, session, url, payload, check=True):
+        headers = {
+            'Content-Type': 'application/json',
+            'Accept': 'application/json'
+        }
+        response = session.post(url, headers=headers, data=json.dumps(payload), timeout=self.FETCH_TIMEOUT)
+        if check:
+            response.raise_for_status()
+        return response
+
+    # Read the expiry timestamp of a JWT token from its exp claim (None if it is not a JWT or has no expiry)
+    def get_jwt_expiry(self, token):
+        try:
+            payload = token.split('.')[1]
+            return float(json.loads(base64.urlsafe_b64decode(payload + '=' * (-len(payload) % 4)))['exp'])
+        except (IndexError, ValueError, KeyError, TypeError):
+            return None
+
+    # Fetch a token in the login thread, and cache it with its expiry. Failures are logged and delay the next fetch
+    async def fetch_token(self):
+        try:
+            result = await asyncio.get_running_loop().run_in_executor(self.executor, self.get_token, self.session)
+        except Exception as e:
+            self.failures += 1
+            backoff = min(self.RETRY_BACKOFF_MIN * 2 ** (self.failures - 1), self.RETRY_BACKOFF_MAX)
+            self.retry_at = time.monotonic() + backoff
+            print(f"[WARN] Could not retrieve token: {e}. Retrying in {backoff} seconds at the earliest.")
+            return self.token
+        token, expires_at = result if isinstance(result, tuple) else (result, None)
+        if expires_at is None and self.TOKEN_TTL is not None:
+            expires_at = time.time() + self.TOKEN_TTL
+        self.token = token
+        self.expires_at = expires_at
+        self.failures = 0
+        self.retry_at = 0
+        print(f"Token retrieved: {self.token}")
+        return self.token
+
+    # Start a fetch, unless one is in flight already, in which case it is shared
+    def start_fetch(self):
+        if self.fetch is None or self.fetch.done():
+            self.fetch = asyncio.ensure_future(self.fetch_token())
+        return self.fetch
+
+    async def request(self, flow):
+        now = time.time()
+        in_flight = self.fetch is not None and not self.fetch.done()
+        backing_off = time.monotonic() < self.retry_at
+        if self.token is not None and (self.expires_at is None or now < self.expires_at):
+            if self.expires_at is not None and now >= self.expires_at - self.REFRESH_MARGIN and not in_flight and not backing_off:
+                self.start_fetch()
+            self.apply_token(flow, self.token)
+            return
+        # No valid token: wait for a fetch (shielded, so that a killed flow does not cancel it for the others)
+        token = self.token
+        if in_flight or not backing_off:
+            token = await asyncio.shield(self.start_fetch())
+        if token is not None:
+            self.apply_token(flow, token)
+
+    def done(self):
+        self.executor.shutdown(wait=False)
+        self.session.close()
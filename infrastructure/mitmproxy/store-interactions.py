@@ -1,33 +1,205 @@
 import sqlite3
 import os
+import queue
+import threading
+import time
+import zlib
+import json
+import collections
 
 class StoreInteractions:
 
+    # Pending interactions are committed every FLUSH_INTERVAL seconds, or as soon as FLUSH_COUNT of them are queued. A
+    # batch that cannot be committed is kept and retried at the next flush (and up to FLUSH_RETRIES times at shutdown)
+    FLUSH_INTERVAL = 1
+    FLUSH_COUNT = 100
+    FLUSH_RETRIES = 5
+
+    # The pid of the proxy is written to PID_FILE, so that the orchestrator can stop the proxy cleanly (with SIGTERM)
+    # before stopping the container, and the pending interactions are stored
+    PID_FILE = '/tmp/store-interactions.pid'
+
+    # Bodies are stored as UTF-8 text ('text'), raw bytes ('blob') or zlib-compressed bytes when smaller ('zlib'),
+    # and truncated to BODY_SIZE_CAP bytes if it is greater than 0 (the *_content_size columns keep the original size)
+    BODY_STORAGES = ['text', 'blob', 'zlib']
+    BODY_STORAGE = os.environ.get('BODY_STORAGE', 'text')
+    BODY_SIZE_CAP = int(os.environ.get('BODY_SIZE_CAP', 0))
+
+    # Live metrics of the run are written to LIVE_METRICS_FILENAME every METRICS_INTERVAL seconds, with the request rate
+    # over the last METRICS_WINDOW seconds and latency percentiles over the last LATENCY_WINDOW interactions
+    LIVE_METRICS_FILENAME = 'live-metrics.json'
+    METRICS_INTERVAL = 5
+    METRICS_WINDOW = 60
+    LATENCY_WINDOW = 1000
+
     conn = None
     cursor = None
     count = 0
 
     def __init__(self):
+        if self.BODY_STORAGE not in self.BODY_STORAGES:
+            print(f"Unknown body storage '{self.BODY_STORAGE}' (valid values: {', '.join(self.BODY_STORAGES)}). Storing bodies as text.")
+            self.BODY_STORAGE = 'text'
         self.conn = self.open_sqlite()
         self.cursor = self.conn.cursor()
         self.init_sqlite()
+        self.init_metrics()
+        # Interactions are handed over to a writer thread, so that the proxy never waits for the database
+        self.queue = queue.SimpleQueue()
+        self.writer = threading.Thread(target=self.write_interactions, daemon=True)
+        self.writer.start()
+        try:
+            with open(self.PID_FILE, 'w') as f:
+                f.write(str(os.getpid()))
+        except OSError as e:
+            print(f"Could not write pid file: {e}")
+
+    def get_results_path(self):
+        return f"./results/{os.environ['API']}/{os.environ['TOOL']}/{os.environ['RUN']}"
 
     def open_sqlite(self):
-        return sqlite3.connect(f"./results/{os.environ['API']}/{os.environ['TOOL']}/{os.environ['RUN']}/results.db")
-    
+        conn = sqlite3.connect(f"{self.get_results_path()}/results.db", check_same_thread=False)
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute('PRAGMA synchronous=NORMAL')
+        return conn
+
+    # Create the interactions table with the indexes used by verification and analysis, so that they are maintained
+    # while capturing instead of being built over the whole table afterwards
     def init_sqlite(self):
-        self.cursor.execute('CREATE TABLE interactions (id integer PRIMARY KEY, request_method text, request_path text, request_headers text, request_content text, request_timestamp real, response_status_code integer, response_headers text, response_content text, response_timestamp real)')
+        content_type = 'text' if self.BODY_STORAGE == 'text' else 'blob'
+        self.cursor.execute(f'CREATE TABLE interactions (id integer PRIMARY KEY, request_method text, request_path text, request_headers text, request_content {content_type}, request_timestamp real, response_status_code integer, response_headers text, response_content {content_type}, response_timestamp real, request_content_encoding text, request_content_size integer, response_content_encoding text, response_content_size integer)')
+        self.cursor.execute('CREATE INDEX idx_interaction_response_status_code ON interactions (response_status_code ASC)')
+        self.cursor.execute('CREATE INDEX idx_interaction_request_timestamp ON interactions (request_timestamp ASC)')
         self.conn.commit()
-    
-    def response(self, flow):
-        self.cursor.execute('INSERT INTO interactions (request_method, request_path, request_headers, request_content, request_timestamp, response_status_code, response_headers, response_content, response_timestamp) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)', (flow.request.method, flow.request.path, bytes(flow.request.headers).decode('utf-8'), flow.request.content.decode('utf-8'), flow.request.timestamp_start, flow.response.status_code, bytes(flow.response.headers).decode('utf-8'), flow.response.content.decode('utf-8'), flow.response.timestamp_start))
-        self.count += 1
-        if self.count % 100 == 0:
+
+    # Prepare a body for storage, returning the stored value, its encoding ('identity' or 'zlib') and the original size
+    def encode_body(self, content):
+        if content is None:
+            content = b''
+        size = len(content)
+        if self.BODY_SIZE_CAP > 0 and size > self.BODY_SIZE_CAP:
+            content = content[:self.BODY_SIZE_CAP]
+        if self.BODY_STORAGE == 'text':
+            return content.decode('utf-8', errors='backslashreplace'), 'identity', size
+        if self.BODY_STORAGE == 'zlib':
+            compressed = zlib.compress(content)
+            if len(compressed) < len(content):
+                return compressed, 'zlib', size
+        return content, 'identity', size
+
+    # Convert a captured interaction to a database row
+    def to_row(self, interaction):
+        (request_method, request_path, request_headers, request_content, request_timestamp, response_status_code, response_headers, response_content, response_timestamp) = interaction
+        request_content, request_content_encoding, request_content_size = self.encode_body(request_content)
+        response_content, response_content_encoding, response_content_size = self.encode_body(response_content)
+        return (request_method, request_path, request_headers.decode('utf-8', errors='backslashreplace'), request_content, request_timestamp, response_status_code, response_headers.decode('utf-8', errors='backslashreplace'), response_content, response_timestamp, request_content_encoding, request_content_size, response_content_encoding, response_content_size)
+
+    # Insert pending rows in a single transaction. Returns whether they were stored (if not, the transaction is rolled back)
+    def flush(self, rows):
+        try:
+            self.cursor.executemany('INSERT INTO interactions (request_method, request_path, request_headers, request_content, request_timestamp, response_status_code, response_headers, response_content, response_timestamp, request_content_encoding, request_content_size, response_content_encoding, response_content_size) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)', rows)
             self.conn.commit()
+        except sqlite3.Error as e:
+            print(f"Could not store {len(rows)} interactions, retrying: {e}")
+            try:
+                self.conn.rollback()
+            except sqlite3.Error:
+                pass
+            return False
+        self.count += len(rows)
+        return True
 
-addons = [StoreInteractions()]
+    def init_metrics(self):
+        self.started = time.time()
+        self.metrics = {'requests': 0, '2XX': 0, '4XX': 0, '5XX': 0}
+        self.paths = set()
+        self.latencies = collections.deque(maxlen=self.LATENCY_WINDOW)
+        self.rate_points = collections.deque()
+        self.last_metrics = time.monotonic()
 
+    # Update live counters with a captured interaction
+    def count_interaction(self, interaction):
+        self.metrics['requests'] += 1
+        status_class = f'{interaction[5] // 100}XX'
+        if status_class in self.metrics:
+            self.metrics[status_class] += 1
+        self.paths.add(interaction[1].split('?')[0])
+        self.latencies.append(interaction[8] - interaction[4])
 
+    # Write live metrics to file (to a temporary file first, so that readers never see it truncated)
+    def write_metrics(self):
+        now = time.monotonic()
+        self.rate_points.append((now, self.metrics['requests']))
+        while now - self.rate_points[0][0] > self.METRICS_WINDOW:
+            self.rate_points.popleft()
+        oldest_time, oldest_requests = self.rate_points[0]
+        requests_per_sec = (self.metrics['requests'] - oldest_requests) / (now - oldest_time) if now > oldest_time else 0
+        latencies = sorted(self.latencies)
+        metrics = dict(self.metrics)
+        metrics['timestamp'] = time.time()
+        metrics['elapsed_secs'] = metrics['timestamp'] - self.started
+        metrics['requests_per_sec'] = requests_per_sec
+        metrics['requests_per_min'] = requests_per_sec * 60
+        metrics['distinct_paths'] = len(self.paths)
+        metrics['latency_p50'] = latencies[len(latencies) // 2] if latencies else None
+        metrics['latency_p99'] = latencies[min(len(latencies) - 1, len(latencies) * 99 // 100)] if latencies else None
+        metrics_path = f"{self.get_results_path()}/{self.LIVE_METRICS_FILENAME}"
+        try:
+            with open(metrics_path + '.tmp', 'w') as f:
+                json.dump(metrics, f)
+            os.replace(metrics_path + '.tmp', metrics_path)
+        except OSError as e:
+            print(f"Could not write live metrics: {e}")
+        self.last_metrics = now
 
+    # Writer thread: store queued interactions until None is received. Errors never stop the thread: an interaction that
+    # cannot be converted is dropped, and a batch that cannot be committed is kept for the next flush
+    def write_interactions(self):
+        pending = []
+        last_flush = time.monotonic()
+        stopping = False
+        while not stopping:
+            try:
+                interaction = self.queue.get(timeout=max(0, self.FLUSH_INTERVAL - (time.monotonic() - last_flush)))
+                if interaction is None:
+                    stopping = True
+                else:
+                    try:
+                        pending.append(self.to_row(interaction))
+                        self.count_interaction(interaction)
+                    except Exception as e:
+                        print(f"Could not store interaction {interaction[0]} {interaction[1]}: {e}")
+            except queue.Empty:
+                pass
+            if stopping or len(pending) >= self.FLUSH_COUNT or time.monotonic() - last_flush >= self.FLUSH_INTERVAL:
+                if len(pending) > 0 and self.flush(pending):
+                    pending = []
+                last_flush = time.monotonic()
+            if stopping or time.monotonic() - self.last_metrics >= self.METRICS_INTERVAL:
+                try:
+                    self.write_metrics()
+                except Exception as e:
+                    print(f"Could not compute live metrics: {e}")
+        # At shutdown, a batch that could not be committed is retried a few more times before giving up
+        for _ in range(self.FLUSH_RETRIES):
+            if len(pending) == 0 or self.flush(pending):
+                return
+            time.sleep(self.FLUSH_INTERVAL)
+        print(f"Could not store {len(pending)} interactions at shutdown.")
 
+    def response(self, flow):
+        self.queue.put((flow.request.method, flow.request.path, bytes(flow.request.headers), flow.request.content, flow.request.timestamp_start, flow.response.status_code, bytes(flow.response.headers), flow.response.content, flow.response.timestamp_start))
+
+    # Store the remaining interactions when mitmproxy shuts down (including on SIGTERM), and leave a single database file
+    # behind
+    def done(self):
+        self.queue.put(None)
+        self.writer.join()
+        self.conn.execute('PRAGMA journal_mode=DELETE')
+        self.conn.close()
+        try:
+            os.remove(self.PID_FILE)
+        except OSError:
+            pass
 
+addons = [StoreInteractions()]
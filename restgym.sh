@@ -68,6 +68,24 @@ case "$1" in
     ;;
 
 
+  # Compares tools on each API with statistical tests
+  compare-results|m)
+    exec $DOCKER_BASE_COMMAND python3 src/compare_results.py
+    ;;
+
+
+  # Rebuilds the catalog of results by scanning the results folder
+  rebuild-catalog|c)
+    exec $DOCKER_BASE_COMMAND python3 src/catalog.py
+    ;;
+
+
+  # Simulates the execution of runs on two Docker hosts, with fake Docker clients
+  simulate-hosts|h)
+    exec $DOCKER_BASE_COMMAND python3 src/simulate_hosts.py
+    ;;
+
+
   # Stops all RESTgym-related containers
   force-stop|s)
     # List container IDs whose names include "restgym"
@@ -99,7 +117,7 @@ case "$1" in
 
 
   *)
-    echo "Usage: $0 {build-images|b|launch-experiment|l|verify-data|v|analyze-data|a|force-stop|s|remove|r|version}" >&2
+    echo "Usage: $0 {build-images|b|launch-experiment|l|verify-data|v|analyze-data|a|compare-results|m|rebuild-catalog|c|simulate-hosts|h|force-stop|s|remove|r|version}" >&2
     exit 1
     ;;
 esac
\ No newline at end of file
@@ -1,9 +1,12 @@
 import common
 import os
 import sys
-import math
-import multiprocessing
 import concurrent.futures
+import time
+
+
+BUILD_WORKERS = 4      # Maximum number of images built at the same time
+BUILD_LOGS_PATH = f'{common.RESTGYM_BASE_DIR}/results/build-logs'
 
 
 
@@ -18,39 +21,70 @@ def clean_builds():
         except:
             print("Image not found. Skipping.")
 
-def build(image):
+# Build the image of an API or tool, streaming the build output to a log file. Returns the outcome and the duration
+def build(image, tools):
+    start_time = time.monotonic()
     try:
         common.DOCKER_CLIENT.images.get(common.DOCKER_PREFIX+image)
         print(f" => {image}: Already available in the local image registry.")
+        return 'available', time.monotonic() - start_time
     except:
-        sub_path = 'tools' if image in common.get_tools() else 'apis'
-        path = f"{common.RESTGYM_BASE_DIR}/{sub_path}/{image}"
-        print(f" => {image}: Building...")
-        if os.path.exists(f"{path}/Dockerfile"):
-            try:
-                common.DOCKER_CLIENT.images.build(
-                    path=f'{common.RESTGYM_BASE_DIR}',
-                    dockerfile=f'{path}/Dockerfile',
-                    tag=common.DOCKER_PREFIX+image,
-                    rm=True,
-                    forcerm=True
-                )
-                print(f" => {image}: Done.")
-            except Exception as e: 
-                print(f" => {image}: An error occurred during the build. Skipping.")
-                print(f" => {image}: {e}")
-        else:
-            print(f" => {image}: Dockerfile not found. Skipping.")
+        pass
+    sub_path = 'tools' if image in tools else 'apis'
+    path = f"{common.RESTGYM_BASE_DIR}/{sub_path}/{image}"
+    if not os.path.exists(f"{path}/Dockerfile"):
+        print(f" => {image}: Dockerfile not found. Skipping.")
+        return 'skipped', time.monotonic() - start_time
+    log_path = f"{BUILD_LOGS_PATH}/{image}.log"
+    print(f" => {image}: Building... (log: {log_path})")
+    try:
+        with open(log_path, 'w') as log:
+            error = None
+            for chunk in common.DOCKER_CLIENT.api.build(
+                path=f'{common.RESTGYM_BASE_DIR}',
+                dockerfile=f'{path}/Dockerfile',
+                tag=common.DOCKER_PREFIX+image,
+                rm=True,
+                forcerm=True,
+                decode=True
+            ):
+                if 'stream' in chunk:
+                    log.write(chunk['stream'])
+                elif 'status' in chunk:
+                    log.write(f"{chunk['status']} {chunk.get('progress', '')}\n")
+                if 'error' in chunk:
+                    error = chunk['error']
+                    log.write(f"ERROR: {error}\n")
+                log.flush()
+        if error is not None:
+            raise Exception(error)
+        print(f" => {image}: Done.")
+        return 'built', time.monotonic() - start_time
+    except Exception as e:
+        print(f" => {image}: An error occurred during the build. Skipping.")
+        print(f" => {image}: {e}")
+        return 'failed', time.monotonic() - start_time
 
 def build_all():
     print("Building images...")
-    images = common.get_apis() + common.get_tools()
+    tools = common.get_tools()
+    images = common.get_apis() + tools
+    os.makedirs(BUILD_LOGS_PATH, exist_ok=True, mode=0o777)
 
-    threads = math.floor(multiprocessing.cpu_count() * 0.9)
+    results = {}
+    with concurrent.futures.ThreadPoolExecutor(BUILD_WORKERS) as executor:
+        futures = {executor.submit(build, image, tools): image for image in images}
+        for future in concurrent.futures.as_completed(futures):
+            results[futures[future]] = future.result()
 
-    with concurrent.futures.ThreadPoolExecutor(threads) as executor:
-        for image in images:
-            build(image)
+    # Summary of builds
+    print("Build summary:")
+    for image in sorted(results):
+        outcome, duration = results[image]
+        print(f" => {image}: {outcome} ({duration:.0f} s)")
+    failed = [image for image in results if results[image][0] == 'failed']
+    if len(failed) > 0:
+        print(f"{len(failed)} image(s) failed to build: {', '.join(sorted(failed))}. See the logs in {BUILD_LOGS_PATH}.")
 
 # Main
 if __name__ == "__main__":
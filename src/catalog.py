@@ -0,0 +1,257 @@
+import common
+import sqlite3
+import os
+import re
+import json
+import time
+
+
+CATALOG_PATH = f'{common.RESTGYM_BASE_DIR}/results/catalog.db'
+CATALOG_TIMEOUT_SECS = 60
+# Run states, each corresponding to a marker file in the run directory (the marker files remain the source of truth)
+RUN_STATES = {
+    'started': 'started.txt',
+    'completed': 'completed.txt',
+    'verified': 'verified.txt',
+    'processed': 'summary.json'
+}
+# Metrics of the cumulative results of processed runs
+CUMULATIVE_METRICS = ['success_count', 'client_error_count', 'server_error_count', 'operation_coverage', 'unique_faults', 'branch_coverage', 'line_coverage', 'method_coverage']
+
+
+# Open the catalog of results, creating it if missing (a new catalog is filled by scanning the results folder once)
+def open_catalog():
+    os.makedirs(os.path.dirname(CATALOG_PATH), exist_ok=True)
+    conn = sqlite3.connect(CATALOG_PATH, timeout=CATALOG_TIMEOUT_SECS)
+    # The default (rollback) journal is used, as the results folder can be shared between hosts through NFS, where WAL is
+    # not supported
+    conn.execute('PRAGMA journal_mode=DELETE')
+    created = conn.execute("SELECT COUNT(1) FROM sqlite_master WHERE type = 'table' AND name = 'runs'").fetchone()[0] == 0
+    conn.execute('CREATE TABLE IF NOT EXISTS runs (api TEXT, tool TEXT, run TEXT, started INTEGER DEFAULT 0, completed INTEGER DEFAULT 0, verified INTEGER DEFAULT 0, processed INTEGER DEFAULT 0, time_budget INTEGER, interactions INTEGER, branch_coverage REAL, line_coverage REAL, method_coverage REAL, updated REAL, PRIMARY KEY (api, tool, run))')
+    conn.execute('DROP TABLE IF EXISTS tool_dirs')
+    # Cumulative results of processed runs, with the area under each metric (its sum over the rows up to the current
+    # one), so that aggregated results at any interaction number are a lookup rather than a scan of the run database
+    metric_columns = ', '.join(f'{metric} NUMERIC, area_{metric} NUMERIC' for metric in CUMULATIVE_METRICS)
+    conn.execute(f'CREATE TABLE IF NOT EXISTS cumulative_results (api TEXT, tool TEXT, run TEXT, interaction_number INTEGER, {metric_columns}, PRIMARY KEY (api, tool, run, interaction_number))')
+    # Cumulative results of processed runs sampled by the seconds elapsed since the first request, for time-based
+    # analyses. Catalogs created before this table existed have their cumulative results loaded again from the run
+    # databases, so that both tables are filled
+    if conn.execute("SELECT COUNT(1) FROM sqlite_master WHERE type = 'table' AND name = 'cumulative_results_time'").fetchone()[0] == 0:
+        conn.execute('DELETE FROM cumulative_results')
+    time_metric_columns = ', '.join(f'{metric} NUMERIC' for metric in CUMULATIVE_METRICS)
+    conn.execute(f'CREATE TABLE IF NOT EXISTS cumulative_results_time (api TEXT, tool TEXT, run TEXT, elapsed_secs INTEGER, interaction_number INTEGER, {time_metric_columns}, PRIMARY KEY (api, tool, run, elapsed_secs))')
+    conn.commit()
+    if created:
+        rebuild(conn)
+    return conn
+
+
+# Get the path of a run
+def get_run_path(api, tool, run):
+    return f'{common.RESTGYM_BASE_DIR}/results/{api}/{tool}/{run}'
+
+
+# Split the path of a run in API, tool and run name
+def split_run_path(path):
+    parts = os.path.normpath(path).split(os.sep)
+    return parts[-3], parts[-2], parts[-1]
+
+
+# Read time budget from file (None if missing)
+def read_time_budget(path):
+    try:
+        with open(f'{path}/time-budget.txt', 'r') as f:
+            match = re.search(r'Time budget:\s*(\d+)', f.read())
+    except OSError:
+        return None
+    if match and int(match.group(1)) > 0:
+        return int(match.group(1))
+    return 60
+
+
+# Read the state and key stats of a run from its directory
+def scan_run(path):
+    entry = {state: os.path.exists(f'{path}/{marker}') for state, marker in RUN_STATES.items()}
+    entry['time_budget'] = read_time_budget(path)
+    entry['interactions'] = entry['branch_coverage'] = entry['line_coverage'] = entry['method_coverage'] = None
+    if entry['processed']:
+        try:
+            with open(f'{path}/summary.json', 'r') as f:
+                summary = json.load(f)
+            entry['interactions'] = summary['interactions']['count']
+            entry['branch_coverage'] = summary['final_code_coverage']['branch']
+            entry['line_coverage'] = summary['final_code_coverage']['line']
+            entry['method_coverage'] = summary['final_code_coverage']['method']
+        except (OSError, ValueError, KeyError, TypeError):
+            pass
+    return entry
+
+
+# Insert or update the entries of runs (path -> fields), within the current transaction. Fields that are not given are
+# left unchanged for existing runs
+def upsert_runs(conn, entries):
+    for path, fields in entries.items():
+        api, tool, run = split_run_path(path)
+        conn.execute('INSERT OR IGNORE INTO runs (api, tool, run) VALUES (?, ?, ?)', (api, tool, run))
+        fields = dict(fields, updated=time.time())
+        assignments = ', '.join(f'{column} = ?' for column in fields)
+        conn.execute(f'UPDATE runs SET {assignments} WHERE api = ? AND tool = ? AND run = ?', (*fields.values(), api, tool, run))
+
+
+# Update the catalog entries of runs (path -> fields) in a single transaction. The catalog is an index: if it cannot be
+# updated, the marker files of the runs are still there, and the runs are picked up again by rebuilding the catalog
+def update_runs(entries):
+    try:
+        conn = open_catalog()
+        try:
+            with conn:
+                upsert_runs(conn, entries)
+        finally:
+            conn.close()
+    except sqlite3.Error as e:
+        print(f" => [-WARN] Could not update results catalog: {e}. Rebuild it with catalog.py.")
+
+
+# Update the catalog entry of a run
+def update_run(path, **fields):
+    update_runs({path: fields})
+
+
+# Remove runs from the catalog
+def remove_runs(paths):
+    conn = open_catalog()
+    with conn:
+        conn.executemany('DELETE FROM runs WHERE api = ? AND tool = ? AND run = ?', [split_run_path(path) for path in paths])
+        conn.executemany('DELETE FROM cumulative_results WHERE api = ? AND tool = ? AND run = ?', [split_run_path(path) for path in paths])
+        conn.executemany('DELETE FROM cumulative_results_time WHERE api = ? AND tool = ? AND run = ?', [split_run_path(path) for path in paths])
+    conn.close()
+
+
+# Replace the cumulative results of a processed run, given as (interaction_number, *CUMULATIVE_METRICS) rows sorted by
+# interaction number, and as (elapsed_secs, interaction_number, *CUMULATIVE_METRICS) rows sampled by time, within the
+# current transaction
+def replace_cumulative_results(conn, path, rows, time_rows):
+    api, tool, run = split_run_path(path)
+    areas = [0] * len(CUMULATIVE_METRICS)
+    entries = []
+    for row in rows:
+        entry = [api, tool, run, row[0]]
+        for i, value in enumerate(row[1:1 + len(CUMULATIVE_METRICS)]):
+            areas[i] += value
+            entry += [value, areas[i]]
+        entries.append(entry)
+    columns = ', '.join(f'{metric}, area_{metric}' for metric in CUMULATIVE_METRICS)
+    conn.execute('DELETE FROM cumulative_results WHERE api = ? AND tool = ? AND run = ?', (api, tool, run))
+    conn.executemany(f'INSERT INTO cumulative_results (api, tool, run, interaction_number, {columns}) VALUES ({", ".join(["?"] * (4 + 2 * len(CUMULATIVE_METRICS)))})', entries)
+    time_columns = ', '.join(CUMULATIVE_METRICS)
+    conn.execute('DELETE FROM cumulative_results_time WHERE api = ? AND tool = ? AND run = ?', (api, tool, run))
+    conn.executemany(f'INSERT INTO cumulative_results_time (api, tool, run, elapsed_secs, interaction_number, {time_columns}) VALUES ({", ".join(["?"] * (5 + len(CUMULATIVE_METRICS)))})', [(api, tool, run, *time_row) for time_row in time_rows])
+
+
+# Record a processed run: its key stats and its cumulative results, in a single transaction
+def update_processed_run(path, interactions, final_code_coverage, cumulative_results, cumulative_results_time):
+    try:
+        conn = open_catalog()
+        try:
+            with conn:
+                upsert_runs(conn, {path: {'processed': True, 'interactions': interactions, 'branch_coverage': final_code_coverage['branch'], 'line_coverage': final_code_coverage['line'], 'method_coverage': final_code_coverage['method']}})
+                replace_cumulative_results(conn, path, cumulative_results, cumulative_results_time)
+        finally:
+            conn.close()
+    except sqlite3.Error as e:
+        print(f" => [-WARN] Could not update results catalog: {e}. Rebuild it with catalog.py.")
+
+
+# Get the processed runs whose cumulative results are not in the catalog (e.g., processed before the catalog existed)
+def get_runs_without_cumulative_results():
+    conn = open_catalog()
+    runs = {get_run_path(api, tool, run) for api, tool, run in conn.execute('SELECT api, tool, run FROM runs r WHERE processed = 1 AND NOT EXISTS (SELECT 1 FROM cumulative_results c WHERE c.api = r.api AND c.tool = r.tool AND c.run = r.run)')}
+    conn.close()
+    return runs
+
+
+# Store the cumulative results of processed runs (path -> (rows, time rows)), in a single transaction
+def store_cumulative_results(cumulative_results):
+    conn = open_catalog()
+    with conn:
+        for path, (rows, time_rows) in cumulative_results.items():
+            replace_cumulative_results(conn, path, rows, time_rows)
+    conn.close()
+
+
+# Get the minimum number of interactions of processed runs, for each API
+def get_minimum_interactions():
+    conn = open_catalog()
+    minimums = {api: minimum for api, minimum in conn.execute('SELECT api, MIN(interactions) FROM runs WHERE processed = 1 GROUP BY api')}
+    conn.close()
+    return minimums
+
+
+# Get the cumulative results of processed runs, with their areas, at the given interaction number of each API, or at the
+# last sampled interaction number before it (path -> (interaction_number, metric, area of metric, ...), for the metrics
+# in CUMULATIVE_METRICS)
+def get_cumulative_results_at(interaction_numbers):
+    conn = open_catalog()
+    conn.execute('CREATE TEMP TABLE interaction_numbers (api TEXT PRIMARY KEY, interaction_number INTEGER)')
+    conn.executemany('INSERT INTO interaction_numbers (api, interaction_number) VALUES (?, ?)', interaction_numbers.items())
+    columns = ', '.join(f'c.{metric}, c.area_{metric}' for metric in CUMULATIVE_METRICS)
+    results = {}
+    for row in conn.execute(f'SELECT r.api, r.tool, r.run, c.interaction_number, {columns} FROM runs r JOIN interaction_numbers n ON r.api = n.api JOIN cumulative_results c ON c.api = r.api AND c.tool = r.tool AND c.run = r.run AND c.interaction_number = (SELECT MAX(c2.interaction_number) FROM cumulative_results c2 WHERE c2.api = r.api AND c2.tool = r.tool AND c2.run = r.run AND c2.interaction_number <= n.interaction_number) WHERE r.processed = 1'):
+        results[get_run_path(row[0], row[1], row[2])] = row[3:]
+    conn.close()
+    return results
+
+
+# Rebuild the catalog from the results folder, scanning every run directory. The catalog is kept up to date by the
+# scripts that change the runs, so this is only needed when runs are added, removed or changed by hand
+def rebuild(conn):
+    results_dir = f'{common.RESTGYM_BASE_DIR}/results'
+    run_paths = {}
+    if os.path.isdir(results_dir):
+        for api_dir in os.scandir(results_dir):
+            if api_dir.is_dir():
+                for tool_dir in os.scandir(api_dir):
+                    if tool_dir.is_dir():
+                        for run_dir in os.scandir(tool_dir):
+                            if run_dir.is_dir():
+                                run_paths[(api_dir.name, tool_dir.name, run_dir.name)] = run_dir.path
+    # Forget runs whose directory no longer exists
+    removed_runs = {(api, tool, run) for api, tool, run in conn.execute('SELECT api, tool, run FROM runs')}.difference(run_paths)
+
+    with conn:
+        upsert_runs(conn, {path: scan_run(path) for path in run_paths.values()})
+        conn.executemany('DELETE FROM runs WHERE api = ? AND tool = ? AND run = ?', removed_runs)
+        conn.executemany('DELETE FROM cumulative_results WHERE api = ? AND tool = ? AND run = ?', removed_runs)
+        conn.executemany('DELETE FROM cumulative_results_time WHERE api = ? AND tool = ? AND run = ?', removed_runs)
+
+
+# Get the paths of the runs in the catalog, optionally only those in the given state
+def get_runs(state=None):
+    conn = open_catalog()
+    query = 'SELECT api, tool, run FROM runs'
+    if state is not None:
+        if state not in RUN_STATES:
+            raise ValueError(f'Unknown run state: {state}')
+        query += f' WHERE {state} = 1'
+    runs = {get_run_path(api, tool, run) for api, tool, run in conn.execute(query)}
+    conn.close()
+    return runs
+
+
+# Count the completed runs of each API and tool
+def count_completed_runs():
+    conn = open_catalog()
+    counts = {(api, tool): count for api, tool, count in conn.execute('SELECT api, tool, COUNT(1) FROM runs WHERE completed = 1 GROUP BY api, tool')}
+    conn.close()
+    return counts
+
+
+# Main
+if __name__ == '__main__':
+    common.welcome()
+    print("This is the catalog module. It will rebuild the catalog of results by scanning the results folder.")
+    conn = open_catalog()
+    rebuild(conn)
+    for state in RUN_STATES:
+        print(f"{state.capitalize()} runs: {conn.execute(f'SELECT COUNT(1) FROM runs WHERE {state} = 1').fetchone()[0]}")
+    conn.close()
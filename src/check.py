@@ -1,27 +1,30 @@
 import common
+import catalog
 import sqlite3
 import os
 import sys
 import shutil
 import re
 import time
+import json
+import concurrent.futures
 
 
+INTEGRITY_CHECK = 'full'            # 'full' (PRAGMA integrity_check) or 'quick' (PRAGMA quick_check, skips index content checks)
+CHECK_WORKERS = os.cpu_count() or 1
+CHECK_MANIFEST_FILENAME = 'check-manifest.json'
+GENERATE_MISSING_REPORTS = False    # Generate the missing code coverage reports of runs (with a local JDK) before verifying them
+# Files whose modification time and size identify the state of a run (a run whose files are unchanged is not re-verified).
+# Only what the run itself produces is considered, as the analysis also writes to the database of the run: the markers,
+# and the code coverage directory (whose modification time changes only when per-sample files of older images are added)
+RUN_FINGERPRINT_FILES = ['started.txt', 'completed.txt', 'time-budget.txt', common.CODE_COVERAGE_PATH.lstrip('/')]
+# Append-only files of the run, identified by their size only
+RUN_FINGERPRINT_SIZE_FILES = [f'{common.CODE_COVERAGE_PATH.lstrip("/")}/{common.COVERAGE_SAMPLES_INDEX_FILENAME}', f'{common.CODE_COVERAGE_PATH.lstrip("/")}/{common.COVERAGE_SAMPLES_CSV_FILENAME}']
+
 
 # Collect paths of runs
 def collect_runs():
-    runs = set()
-    api_dirs = os.scandir(f'{common.RESTGYM_BASE_DIR}/results')
-    for api_dir in api_dirs:
-        if api_dir.is_dir():
-            tool_dirs = os.scandir(api_dir)
-            for tool_dir in tool_dirs:
-                if tool_dir.is_dir():
-                    run_dirs = os.scandir(tool_dir)
-                    for run_dir in run_dirs:
-                        if run_dir.name != '.DS_Store':
-                            runs.add(run_dir.path)
-    return runs
+    return catalog.get_runs()
 
 
 # Read time budget from file
@@ -39,13 +42,23 @@ def parse_time_budget(file_path):
     return 60
 
 
-# Count code coverage samples
+# Count code coverage samples, in the coverage store of the run (indexed exec dumps, and distinct sample times of the
+# CSV reports) and in per-sample files of runs collected by older images
 def count_coverage_samples(run):
-    files = os.listdir(f"{run}{common.CODE_COVERAGE_PATH}")
+    coverage_dir = f"{run}{common.CODE_COVERAGE_PATH}"
+    files = os.listdir(coverage_dir)
     exec_count = 0
     csv_count = 0
     for file in files:
-        if file.endswith('.exec'):
+        if file == common.COVERAGE_SAMPLES_INDEX_FILENAME:
+            with open(f"{coverage_dir}/{file}") as f:
+                exec_count += sum(1 for line in f if len(line.split()) == 3)
+        elif file == common.COVERAGE_SAMPLES_CSV_FILENAME:
+            with open(f"{coverage_dir}/{file}") as f:
+                csv_count += len(set(line.partition(',')[0] for line in f if line.endswith('\n')).difference(['SAMPLE_TIME']))
+        elif file == common.COVERAGE_SAMPLES_EXEC_FILENAME:
+            continue
+        elif file.endswith('.exec'):
             exec_count += 1
         elif file.endswith('.csv'):
             csv_count += 1
@@ -53,87 +66,172 @@ def count_coverage_samples(run):
 
 
 # Verify SQLite database integrity
-def verify_database_integrity(run):
-    conn = sqlite3.connect(f'{run}/{common.DB_FILENAME}')
-    cursor = conn.cursor()
-    cursor.execute("PRAGMA integrity_check;")
+def verify_database_integrity(cursor):
+    cursor.execute(f"PRAGMA {'quick_check' if INTEGRITY_CHECK == 'quick' else 'integrity_check'};")
     result = cursor.fetchone()
-    conn.close()
     if result[0] == "ok":
         return True
     else:
         return False
 
 
-# Perform integrity analysis
-def analyze():
+# Get the fingerprint of a run: modification time and size of the files produced by the run (None for missing files), and
+# whether its database exists
+def get_run_fingerprint(run):
+    fingerprint = []
+    for file in RUN_FINGERPRINT_FILES + RUN_FINGERPRINT_SIZE_FILES:
+        try:
+            stat = os.stat(f'{run}/{file}')
+            fingerprint.append([stat.st_mtime_ns, stat.st_size] if file in RUN_FINGERPRINT_FILES else stat.st_size)
+        except OSError:
+            fingerprint.append(None)
+    fingerprint.append(os.path.exists(f'{run}/{common.DB_FILENAME}'))
+    return fingerprint
+
+
+# Load the manifest of verified runs (empty if missing or unreadable)
+def load_manifest():
+    try:
+        with open(f'{common.RESTGYM_BASE_DIR}/results/{CHECK_MANIFEST_FILENAME}', 'r') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+# Store the manifest of verified runs (written to a temporary file first, so that it is never left truncated)
+def save_manifest(manifest):
+    manifest_path = f'{common.RESTGYM_BASE_DIR}/results/{CHECK_MANIFEST_FILENAME}'
+    try:
+        with open(manifest_path + '.tmp', 'w') as f:
+            json.dump(manifest, f)
+        os.replace(manifest_path + '.tmp', manifest_path)
+    except OSError as e:
+        print(f" => [-WARN] Could not store verification manifest: {e}")
+
+
+# Verify a single run, using a single connection to its database
+def verify_run(run):
+    # Get time budget for the run
+    time_budget = parse_time_budget(f'{run}/time-budget.txt')
+    # Init dictionary to store results
+    result = {}
+    # Verify started.txt exists
+    result['started'] = os.path.exists(f'{run}/started.txt')
+    # Verify completed.txt exists
+    result['completed'] = os.path.exists(f'{run}/completed.txt')
+    # Verify database exists
+    result['db'] = os.path.exists(f'{run}/{common.DB_FILENAME}')
+    result['interactions_table'] = False
+    result['requests'] = False
+    result['time_span'] = False
+    if result['db']:
+        conn = sqlite3.connect(f"{run}/{common.DB_FILENAME}")
+        try:
+            cursor = conn.cursor()
+            # Verify database integrity
+            result['db_integrity'] = verify_database_integrity(cursor)
+            # Verify interactions table exists
+            result['interactions_table'] = int(cursor.execute("SELECT COUNT(1) FROM sqlite_master WHERE type='table' AND name = 'interactions'").fetchone()[0]) > 0
+            if result['interactions_table']:
+                # Count requests and compute their time span with a single scan of the table
+                request_count, time_span = cursor.execute('SELECT COUNT(1), MAX(request_timestamp) - MIN(request_timestamp) FROM interactions').fetchone()
+                # Verify at least 130 requests per minute have been sent
+                if "genome-nexus" in run and "schemathesis" in run:
+                    result['requests'] = request_count >= 50 * time_budget
+                else:
+                    result['requests'] = request_count >= 130 * time_budget
+                # Verify requests span is at least 90% of the time budget
+                if result['requests']:
+                    result['time_span'] = time_span >= int(60 * time_budget * 0.9)
+        except sqlite3.DatabaseError:
+            result['db_integrity'] = False
+        finally:
+            conn.close()
+
+    # Verify code coverage dir exists
+    result['coverage_dir'] = os.path.exists(f"{run}{common.CODE_COVERAGE_PATH}")
+    # Verify all code coverage samples exist
+    if result['coverage_dir']:
+        exec_count, csv_count = count_coverage_samples(run)
+        result['exec_count'] = exec_count >= 12 * time_budget
+        result['csv_count'] = csv_count >= 12 * time_budget
+    else:
+        result['exec_count'] = False
+        result['csv_count'] = False
+    return result
+
+
+# Verify a run, returning its fingerprint (taken before verifying, so that a run changing during the verification is
+# verified again next time) and the verification result
+def fingerprint_and_verify_run(run):
+    return get_run_fingerprint(run), verify_run(run)
+
+
+# Generate the missing code coverage reports of runs (e.g., deferred reports that could not be generated at the end of
+# the run), one run at a time. Only the runs that are not in the manifest, or whose reports were missing at their last
+# verification, are considered
+def generate_missing_reports(runs, manifest):
+    for run in sorted(runs):
+        entry = manifest.get(run)
+        if (entry is not None and entry['result'].get('csv_count', True)) or not os.path.exists(f"{run}{common.CODE_COVERAGE_PATH}"):
+            continue
+        exec_count, csv_count = count_coverage_samples(run)
+        if csv_count < exec_count:
+            print(f" => [-INFO] Generating {exec_count - csv_count} missing code coverage report(s) of {run}.")
+            common.generate_coverage_reports(run, CHECK_WORKERS)
+
+
+# Perform integrity analysis, verifying runs in parallel. Runs that are unchanged since their last verification (same
+# fingerprint, verified with the same or a stricter integrity check) are taken from the manifest. In incremental mode,
+# runs in the manifest are not re-verified at all, even if changed
+def analyze(incremental=False):
     runs = collect_runs()
     print(f"Analyzing {len(runs)} runs.")
+    manifest = load_manifest()
+    # Reports are generated before fingerprinting the runs, so that runs whose reports were generated are verified again
+    if GENERATE_MISSING_REPORTS:
+        generate_missing_reports(runs, manifest)
     analyzed = {}
+    runs_to_verify = []
     for run in runs:
-        # Get time budget for the run
-        time_budget = parse_time_budget(f'{run}/time-budget.txt')
-        # Init dictionary to store results
-        result = {}
-        # Verify started.txt exists
-        result['started'] = os.path.exists(f'{run}/started.txt')
-        # Verify completed.txt exists
-        result['completed'] = os.path.exists(f'{run}/completed.txt')
-        # Verify database exists
-        result['db'] = os.path.exists(f'{run}/{common.DB_FILENAME}')
-        # Verify database integrity
-        if result['db']:
-            result['db_integrity'] = verify_database_integrity(run)
-        # Verify interactions table exists
-        if result['db']:
-            conn = sqlite3.connect(f"{run}/{common.DB_FILENAME}")
-            cursor = conn.cursor()
-            result['interactions_table'] = int(cursor.execute("SELECT COUNT(1) FROM sqlite_master WHERE type='table' AND name = 'interactions'").fetchone()[0]) > 0
-        else:
-            result['interactions_table'] = False
-        # Verify at least 130 requests per minute have been sent
-        if result['interactions_table']:
-            if "genome-nexus" in run and "schemathesis" in run:
-                result['requests'] = cursor.execute('SELECT COUNT(1) FROM interactions').fetchone()[0] >= 50 * time_budget
-            else:
-                result['requests'] = cursor.execute('SELECT COUNT(1) FROM interactions').fetchone()[0] >= 130 * time_budget
-        else:
-            result['requests'] = False
-        # Verify requests span is at least 90% of the time budget
-        if result['interactions_table'] and result['requests']:
-            result['time_span'] = cursor.execute('SELECT MAX(request_timestamp) - MIN(request_timestamp) FROM interactions').fetchone()[0] >= int(60 * time_budget * 0.9)
-        else:
-            result['time_span'] = False
-
-        # Verify code coverage dir exists
-        result['coverage_dir'] = os.path.exists(f"{run}{common.CODE_COVERAGE_PATH}")
-        # Verify all code coverage samples exist
-        if result['coverage_dir']:
-            exec_count, csv_count = count_coverage_samples(run)
-            result['exec_count'] = exec_count >= 12 * time_budget
-            result['csv_count'] = csv_count >= 12 * time_budget
-        else:
-            result['exec_count'] = False
-            result['csv_count'] = False
-        # Add result to returned dictionary
-        analyzed[run] = result
-        # Print if something is wrong
-        something_wrong = False
-        for key in result:
-            if not result[key]:
-                something_wrong = True
-                break
-        if something_wrong:
-            print(f" => Something wrong in {run}: {result}")
-        else:
-            with open(f'{run}/verified.txt', 'a') as f:
-                f.write(f'This run was verified at {time.ctime()} and no issues were identified.\n')
+        entry = manifest.get(run)
+        if entry is not None and (entry['integrity_check'] == 'full' or entry['integrity_check'] == INTEGRITY_CHECK):
+            if incremental or entry['fingerprint'] == get_run_fingerprint(run):
+                analyzed[run] = entry['result']
+                continue
+        runs_to_verify.append(run)
+    print(f"{len(analyzed)} runs unchanged since their last verification, verifying {len(runs_to_verify)} runs with {INTEGRITY_CHECK} integrity check.")
+
+    with concurrent.futures.ThreadPoolExecutor(CHECK_WORKERS) as executor:
+        futures = {executor.submit(fingerprint_and_verify_run, run): run for run in runs_to_verify}
+        for future in concurrent.futures.as_completed(futures):
+            run = futures[future]
+            try:
+                fingerprint, result = future.result()
+            except Exception as e:
+                print(f" => [ERROR] Could not verify {run}: {e}")
+                continue
+            analyzed[run] = result
+            manifest[run] = {'fingerprint': fingerprint, 'integrity_check': INTEGRITY_CHECK, 'result': result}
+            if all(result.values()):
+                with open(f'{run}/verified.txt', 'a') as f:
+                    f.write(f'This run was verified at {time.ctime()} and no issues were identified.\n')
+
+    # Forget runs that no longer exist
+    save_manifest({run: manifest[run] for run in manifest if run in runs})
+    catalog.update_runs({run: catalog.scan_run(run) for run in runs_to_verify if run in analyzed})
+
+    # Print if something is wrong
+    for run in sorted(analyzed):
+        if not all(analyzed[run].values()):
+            print(f" => Something wrong in {run}: {analyzed[run]}")
     return analyzed
 
 # Removes runs with problems
 def clean(runs):
     for run in runs:
         shutil.rmtree(run, ignore_errors=True)
+    catalog.remove_runs(runs)
     print("Removed.")
 
 if __name__ == '__main__':
@@ -141,11 +239,13 @@ if __name__ == '__main__':
     print("This is the verify_runs module. It will check the integrity of runs.")
     print("[1] Verify runs")
     print("[2] Verify runs and remove wrong ones")
+    print("[3] Verify new runs only")
+    print("[4] Verify new runs only and remove wrong ones")
     choice = input("Your choice: ")
-    if choice != '1' and choice != '2':
+    if choice not in ['1', '2', '3', '4']:
         print("Invalid choice!")
         sys.exit(1)
-    analyzed = analyze()
+    analyzed = analyze(incremental=choice in ['3', '4'])
     with_problems = []
     for run in analyzed:
         for key in analyzed[run]:
@@ -155,6 +255,6 @@ if __name__ == '__main__':
     if len(with_problems) == 0:
         print("All runs passed the verification.")
     else:
-        if choice == '2':
+        if choice in ['2', '4']:
             input(f"Are you sure you want to delete {len(with_problems)}/{len(analyzed)} runs with integrity issues? Press ENTER to continue, or CTRL+C to cancel...")
             clean(with_problems)
\ No newline at end of file
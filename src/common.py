@@ -1,6 +1,8 @@
 import docker
 import os
 import yaml
+import shutil
+import subprocess
 
 
 
@@ -8,6 +10,10 @@ DOCKER_CLIENT = docker.from_env()
 DOCKER_PREFIX = 'restgym-'
 DB_FILENAME = 'results.db'
 CODE_COVERAGE_PATH = '/code-coverage'
+COVERAGE_SAMPLES_EXEC_FILENAME = 'coverage-samples.exec'
+COVERAGE_SAMPLES_INDEX_FILENAME = 'coverage-samples.idx'
+COVERAGE_SAMPLES_CSV_FILENAME = 'coverage-samples.csv'
+COVERAGE_COLLECTOR_STOP_FILENAME = 'coverage-collector.stop'
 LOGS_PATH = '/logs'
 RESTGYM_BASE_DIR_HOST = os.getenv('RESTGYM_BASE_DIR', os.path.abspath(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')))
 RESTGYM_BASE_DIR = os.path.abspath(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
@@ -52,4 +58,22 @@ def get_tools():
         pass
     tools.remove('#tool-template')
     tools[:] = [x for x in tools if check_enabled('tool', x)]
-    return tools
\ No newline at end of file
+    return tools
+
+# Generate the missing code coverage reports of a completed run from its exec store, running the collector on this
+# machine (which needs a JDK, and the classes of the API). Returns whether the collector was run (some reports could
+# still be missing, if it failed on them)
+def generate_coverage_reports(run, threads=1):
+    coverage_dir = f'{run}{CODE_COVERAGE_PATH}'
+    api = os.path.normpath(run).split(os.sep)[-3]
+    if shutil.which('java') is None or not os.path.exists(f'{coverage_dir}/{COVERAGE_SAMPLES_INDEX_FILENAME}') or not os.path.exists(f'{run}/completed.txt'):
+        return False
+    jacoco_dir = f'{RESTGYM_BASE_DIR}/infrastructure/jacoco'
+    try:
+        result = subprocess.run(['java', '-cp', f'{jacoco_dir}/org.jacoco.cli-0.8.7-nodeps.jar', f'{jacoco_dir}/CoverageCollector.java', 'report', f'{RESTGYM_BASE_DIR}/apis/{api}/classes/', coverage_dir, str(threads)], capture_output=True, text=True)
+    except OSError as e:
+        print(f" => [-WARN] Could not generate code coverage reports of {run}: {e}")
+        return False
+    if result.returncode != 0:
+        print(f" => [-WARN] Some code coverage reports of {run} could not be generated: {result.stderr.strip()}")
+    return True
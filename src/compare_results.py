@@ -0,0 +1,165 @@
+import common
+import catalog
+import process_results
+import sys
+import csv
+import math
+import datetime
+import itertools
+import numpy as np
+
+
+# Axes along which curves can be compared: number of interactions, or seconds elapsed since the first request. Each axis
+# is read from the cumulative results sampled along it (catalog table and column)
+AXES = {
+    'interactions': ('interaction count', 'cumulative_results', 'interaction_number'),
+    'elapsed_secs': ('elapsed time', 'cumulative_results_time', 'elapsed_secs')
+}
+
+
+# Load the cumulative curves of processed runs along an axis from the catalog, once, as NumPy arrays grouped by API and
+# tool ((api, tool) -> run -> {'x': array of points of the axis, increasing, 'metrics': array with one column per metric})
+def load_curves(axis):
+    _, table, column = AXES[axis]
+    conn = catalog.open_catalog()
+    columns = ', '.join(f'c.{metric}' for metric in catalog.CUMULATIVE_METRICS)
+    rows = conn.execute(f'SELECT c.api, c.tool, c.run, c.{column}, {columns} FROM {table} c JOIN runs r ON c.api = r.api AND c.tool = r.tool AND c.run = r.run WHERE r.processed = 1 ORDER BY c.api, c.tool, c.run, c.{column}').fetchall()
+    conn.close()
+    curves = {}
+    for (api, tool, run), run_rows in itertools.groupby(rows, key=lambda row: row[:3]):
+        data = np.array([row[3:] for row in run_rows], dtype=float)
+        curves.setdefault((api, tool), {})[run] = {'x': data[:, 0], 'metrics': data[:, 1:]}
+    return curves
+
+
+# Interpolate the metrics of a curve at a point of the axis (NaN beyond the end of the curve, as the run never got there)
+def interpolate_at(curve, x):
+    xs = curve['x']
+    return np.array([np.interp(x, xs, curve['metrics'][:, i], right=np.nan) for i in range(curve['metrics'].shape[1])])
+
+
+# Compute the area under each metric of a curve up to a point of the axis (trapezoidal rule), normalized by the width of
+# the interval, i.e., the average value of the metric over the interval (NaN if the curve does not reach the point)
+def compute_auc(curve, x):
+    xs = curve['x']
+    if len(xs) == 0 or x > xs[-1] or x <= xs[0]:
+        return np.full(curve['metrics'].shape[1], np.nan)
+    included = xs < x
+    points = np.append(xs[included], x)
+    values = np.vstack([curve['metrics'][included], interpolate_at(curve, x)])
+    return np.trapezoid(values, points, axis=0) / (x - xs[0])
+
+
+# Compute median and interquartile range of values, ignoring NaN
+def summarize(values):
+    values = values[~np.isnan(values)]
+    if len(values) == 0:
+        return math.nan, math.nan
+    q1, median, q3 = np.percentile(values, [25, 50, 75])
+    return median, q3 - q1
+
+
+# Compute Vargha-Delaney A12 effect size: probability that a value of a is greater than a value of b (ties count half)
+def vargha_delaney_a12(a, b):
+    a = a[~np.isnan(a)]
+    b = b[~np.isnan(b)]
+    if len(a) == 0 or len(b) == 0:
+        return math.nan
+    greater = np.sum(a[:, None] > b[None, :])
+    equal = np.sum(a[:, None] == b[None, :])
+    return (greater + 0.5 * equal) / (len(a) * len(b))
+
+
+# Rank values, giving tied values the average of their ranks (ranks start from 1)
+def rank(values):
+    order = np.argsort(values, kind='mergesort')
+    ranks = np.empty(len(values))
+    ranks[order] = np.arange(1, len(values) + 1)
+    _, inverse, counts = np.unique(values, return_inverse=True, return_counts=True)
+    sums = np.bincount(inverse, weights=ranks)
+    return (sums / counts)[inverse]
+
+
+# Compute two-sided Mann-Whitney U test, with normal approximation, tie correction and continuity correction
+# (returns U of a and p-value)
+def mann_whitney_u(a, b):
+    a = a[~np.isnan(a)]
+    b = b[~np.isnan(b)]
+    n1, n2 = len(a), len(b)
+    if n1 == 0 or n2 == 0:
+        return math.nan, math.nan
+    values = np.concatenate([a, b])
+    ranks = rank(values)
+    u = ranks[:n1].sum() - n1 * (n1 + 1) / 2
+    _, counts = np.unique(values, return_counts=True)
+    n = n1 + n2
+    variance = n1 * n2 / 12 * ((n + 1) - np.sum(counts ** 3 - counts) / (n * (n - 1)))
+    if variance <= 0:
+        return u, 1.0
+    z = (abs(u - n1 * n2 / 2) - 0.5) / math.sqrt(variance)
+    return u, min(1.0, math.erfc(max(z, 0) / math.sqrt(2)))
+
+
+# Compare all tools on each API along an axis, at the point reached by all runs of the API (e.g., the minimum number
+# of interactions, as for aggregated results). Returns summary rows (one per API, tool, measure and metric) and pairwise
+# rows (one per API, pair of tools, measure and metric)
+def compare(curves, axis):
+    summary_rows = []
+    pairwise_rows = []
+    apis = sorted(set(api for api, _ in curves))
+    for api in apis:
+        tools = sorted(tool for curve_api, tool in curves if curve_api == api)
+        reference = min(curve['x'].max() for tool in tools for curve in curves[(api, tool)].values())
+        # One row per run, one column per metric
+        measures = {}
+        for tool in tools:
+            runs = curves[(api, tool)].values()
+            measures[tool] = {
+                'value': np.array([interpolate_at(curve, reference) for curve in runs]),
+                'auc': np.array([compute_auc(curve, reference) for curve in runs])
+            }
+        for tool in tools:
+            for measure, values in measures[tool].items():
+                for i, metric in enumerate(catalog.CUMULATIVE_METRICS):
+                    median, iqr = summarize(values[:, i])
+                    summary_rows.append([api, tool, axis, reference, measure, metric, len(values), median, iqr])
+        for tool_a, tool_b in itertools.combinations(tools, 2):
+            for measure in measures[tool_a]:
+                for i, metric in enumerate(catalog.CUMULATIVE_METRICS):
+                    a = measures[tool_a][measure][:, i]
+                    b = measures[tool_b][measure][:, i]
+                    u, p_value = mann_whitney_u(a, b)
+                    pairwise_rows.append([api, tool_a, tool_b, axis, reference, measure, metric, vargha_delaney_a12(a, b), u, p_value])
+    return summary_rows, pairwise_rows
+
+
+# Main
+if __name__ == "__main__":
+    common.welcome()
+    print("This is the comparison module. It will compare tools on each API, based on the cumulative results of analyzed runs.")
+    print("[1] Compare at the same number of interactions")
+    print("[2] Compare at the same elapsed time")
+    choice = input("Your choice: ")
+    if choice != '1' and choice != '2':
+        print("Invalid choice!")
+        sys.exit(1)
+    axis = 'interactions' if choice == '1' else 'elapsed_secs'
+
+    process_results.backfill_cumulative_results()
+    curves = load_curves(axis)
+    if len(curves) == 0:
+        print("No analyzed runs to compare. Please analyze the executed runs, and then try again.")
+        sys.exit(0)
+    print(f"Comparing {sum(len(runs) for runs in curves.values())} runs of {len(curves)} API-tool pairs by {AXES[axis][0]}.")
+
+    summary_rows, pairwise_rows = compare(curves, axis)
+    timestamp = datetime.datetime.now().strftime('%Y%m%dT%H.%M.%S')
+    with open(f"{common.RESTGYM_BASE_DIR}/results/comparison_summary_{timestamp}.csv", mode='w') as summary_file:
+        summary_writer = csv.writer(summary_file, delimiter=',', quotechar='"', quoting=csv.QUOTE_MINIMAL)
+        summary_writer.writerow(['api', 'tool', 'axis', 'reference', 'measure', 'metric', 'runs', 'median', 'iqr'])
+        summary_writer.writerows(summary_rows)
+    with open(f"{common.RESTGYM_BASE_DIR}/results/comparison_pairwise_{timestamp}.csv", mode='w') as pairwise_file:
+        pairwise_writer = csv.writer(pairwise_file, delimiter=',', quotechar='"', quoting=csv.QUOTE_MINIMAL)
+        pairwise_writer.writerow(['api', 'tool_a', 'tool_b', 'axis', 'reference', 'measure', 'metric', 'a12', 'mann_whitney_u', 'p_value'])
+        pairwise_writer.writerows(pairwise_rows)
+    print("Comparison results saved to CSV files.")
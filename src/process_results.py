@@ -1,19 +1,27 @@
 import common
+import catalog
 import os
 import sys
 import sqlite3
 import json
 import re
 import concurrent.futures
+import contextlib
 import multiprocessing
 import math
 import datetime
 import csv
+import bisect
+import functools
+import zlib
 from rich.progress import Progress
 
 
 
-MULTITHREADING = True
+ANALYSIS_MODE = 'processes'         # 'processes' (one process per core), 'threads' or 'sequential'
+# Process pool that parses the coverage samples of all the runs analyzed in this process, shared so that runs analyzed in
+# parallel threads do not start a pool each (set by process_runs, unless runs are analyzed in parallel processes)
+PARSE_EXECUTOR = None
 DEFAULT_JACCARD_SIMILARITY_THRESHOLD = 0.7
 JACCARD_SIMILARITY_THRESHOLDS = {
     'features-service': 0.8,        # Manually confirmed
@@ -30,67 +38,31 @@ JACCARD_SIMILARITY_THRESHOLDS = {
     'blog': 0.7,                    # Manually confirmed (Error with identical text)
     'google-drive': 0.7
 }
+COVERAGE_CACHE_FILENAME = 'coverage-cache.json'
+CUMULATIVE_SAMPLE_STEP = 100        # Cumulative results are sampled every CUMULATIVE_SAMPLE_STEP interactions...
+CUMULATIVE_TIME_STEP_SECS = 10      # ...and every CUMULATIVE_TIME_STEP_SECS seconds since the first interaction (0 to disable)
+AGGREGATE_EXPORT_FORMATS = ['csv']  # 'csv' and/or 'jsonl' (one JSON object per run)
+
+# Number of parallel workers used for the analysis
+def get_analysis_workers():
+    return max(1, math.floor(multiprocessing.cpu_count() * 0.9))
 
 # Collect paths of completed runs (those with completed.txt file)
 def collect_completed_runs():
-    completed_runs = set()
-    api_dirs = os.scandir(f'{common.RESTGYM_BASE_DIR}/results')
-    for api_dir in api_dirs:
-        if api_dir.is_dir():
-            tool_dirs = os.scandir(api_dir)
-            for tool_dir in tool_dirs:
-                if tool_dir.is_dir():
-                    run_dirs = os.scandir(tool_dir)
-                    for run_dir in run_dirs:
-                        if os.path.exists(run_dir.path + '/completed.txt'):
-                            completed_runs.add(run_dir.path)
-    return completed_runs
+    return catalog.get_runs('completed')
 
 
-# Collect paths of completed runs (those with completed.txt file)
+# Collect paths of verified runs (those with verified.txt file)
 def collect_verified_runs():
-    verified_runs = set()
-    api_dirs = os.scandir(f'{common.RESTGYM_BASE_DIR}/results')
-    for api_dir in api_dirs:
-        if api_dir.is_dir():
-            tool_dirs = os.scandir(api_dir)
-            for tool_dir in tool_dirs:
-                if tool_dir.is_dir():
-                    run_dirs = os.scandir(tool_dir)
-                    for run_dir in run_dirs:
-                        if os.path.exists(run_dir.path + '/verified.txt'):
-                            verified_runs.add(run_dir.path)
-    return verified_runs
+    return catalog.get_runs('verified')
 
 # Collect paths of processed run (those with summary.json file)
 def collect_processed_runs():
-    processed_runs = set()
-    api_dirs = os.scandir(f'{common.RESTGYM_BASE_DIR}/results')
-    for api_dir in api_dirs:
-        if api_dir.is_dir():
-            tool_dirs = os.scandir(api_dir)
-            for tool_dir in tool_dirs:
-                if tool_dir.is_dir():
-                    run_dirs = os.scandir(tool_dir)
-                    for run_dir in run_dirs:
-                        if os.path.exists(run_dir.path + '/summary.json'):
-                            processed_runs.add(run_dir.path)
-    return processed_runs
+    return catalog.get_runs('processed')
 
 # Collect paths of summaries
 def collect_summaries():
-    summaries = set()
-    api_dirs = os.scandir(f'{common.RESTGYM_BASE_DIR}/results')
-    for api_dir in api_dirs:
-        if api_dir.is_dir():
-            tool_dirs = os.scandir(api_dir)
-            for tool_dir in tool_dirs:
-                if tool_dir.is_dir():
-                    run_dirs = os.scandir(tool_dir)
-                    for run_dir in run_dirs:
-                        if os.path.exists(run_dir.path + '/summary.json'):
-                            summaries.add(run_dir.path + '/summary.json')
-    return summaries
+    return {processed_run + '/summary.json' for processed_run in collect_processed_runs()}
 
 
 # Read time budget from file
@@ -110,31 +82,25 @@ def parse_time_budget(file_path):
 
 # Find minimum number of requests for API
 def extract_minimum_req_num():
-    result = {}
-    processed_runs = collect_processed_runs()
-    for processed_run in processed_runs:
-        api = processed_run.split('/')[2]
-        with open(f"{processed_run}/summary.json", 'r') as summary_file:
-            req_num = json.load(summary_file)['interactions']['count']
-            if api not in result or result[api] > req_num:
-                result[api] = req_num
-    return result
+    return catalog.get_minimum_interactions()
 
 # Compute statistics on interactions
 def compute_stats_on_interactions(conn: sqlite3.Connection):
     cursor = conn.cursor()
     interactions_stats = {}
-    interactions_stats['count'] = cursor.execute('SELECT COUNT(1) FROM interactions').fetchone()[0]
-    interactions_stats['2XX'] = cursor.execute('SELECT COUNT(1) FROM interactions WHERE response_status_code >= 200 AND response_status_code < 300').fetchone()[0]
-    interactions_stats['4XX'] = cursor.execute('SELECT COUNT(1) FROM interactions WHERE response_status_code >= 400 AND response_status_code < 500').fetchone()[0]
-    interactions_stats['5XX'] = cursor.execute('SELECT COUNT(1) FROM interactions WHERE response_status_code >= 500 AND response_status_code < 600').fetchone()[0]
-    interactions_stats['401'] = cursor.execute('SELECT COUNT(1) FROM interactions WHERE response_status_code = 401').fetchone()[0]
-    interactions_stats['403'] = cursor.execute('SELECT COUNT(1) FROM interactions WHERE response_status_code = 403').fetchone()[0]
-    interactions_stats['covered_operations'] = cursor.execute('SELECT COUNT(DISTINCT operation_id) FROM interactions').fetchone()[0]
-    interactions_stats['unique_5XX'] = cursor.execute('SELECT COUNT(DISTINCT error_bucket_id) FROM interactions').fetchone()[0]
+    # Count interactions by status code with a single pass on the status code index
+    counts_by_status_code = cursor.execute('SELECT response_status_code, COUNT(1) FROM interactions GROUP BY response_status_code').fetchall()
+    interactions_stats['count'] = sum(count for _, count in counts_by_status_code)
+    interactions_stats['2XX'] = sum(count for status_code, count in counts_by_status_code if status_code is not None and 200 <= status_code < 300)
+    interactions_stats['4XX'] = sum(count for status_code, count in counts_by_status_code if status_code is not None and 400 <= status_code < 500)
+    interactions_stats['5XX'] = sum(count for status_code, count in counts_by_status_code if status_code is not None and 500 <= status_code < 600)
+    interactions_stats['401'] = sum(count for status_code, count in counts_by_status_code if status_code == 401)
+    interactions_stats['403'] = sum(count for status_code, count in counts_by_status_code if status_code == 403)
+    interactions_stats['covered_operations'] = cursor.execute('SELECT COUNT(DISTINCT operation_id) FROM interaction_labels').fetchone()[0]
+    interactions_stats['unique_5XX'] = cursor.execute('SELECT COUNT(DISTINCT error_bucket_id) FROM interaction_labels').fetchone()[0]
     return interactions_stats
 
-# Prepare database to add tables and columns for processed results, or clears previous results if already processed
+# Prepare database to add tables for processed results, or clears previous results if already processed
 def prepare_database(conn: sqlite3.Connection, count, total):
 
     cursor = conn.cursor()
@@ -145,17 +111,18 @@ def prepare_database(conn: sqlite3.Connection, count, total):
         print(f" => [ERROR] ({count}/{total}) Missing interaction table.")
         return
 
-    # Create index on response_status_code column
+    # Create indexes on response_status_code and request_timestamp columns (databases recorded by current images already
+    # have them)
     cursor.execute("CREATE INDEX IF NOT EXISTS idx_interaction_response_status_code ON interactions (response_status_code ASC)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_interaction_request_timestamp ON interactions (request_timestamp ASC)")
 
-    # Create columns in "interactions" table to store results, if they do not exist. If they exist, empty them
-    columns = ['operation_id', 'error_bucket_id']
-    for column in columns:
-        column_count = cursor.execute("SELECT COUNT(1) FROM pragma_table_info('interactions') WHERE name = ?", (column,)).fetchone()[0]
-        if column_count < 1:
-            cursor.execute(f"ALTER TABLE interactions ADD COLUMN {column} INTEGER")
-        else:
-            cursor.execute(f"UPDATE interactions SET {column} = NULL")
+    # Delete "interaction_labels" table if exists, as it was the result of previous analysis and it will be recomputed.
+    # Labels derived from interactions are stored in this side table, keyed by interaction id, so that re-analysis never
+    # rewrites the (large) "interactions" table
+    cursor.execute("DROP TABLE IF EXISTS interaction_labels")
+
+    # Create "interaction_labels" table
+    cursor.execute("CREATE TABLE interaction_labels (interaction_id INTEGER PRIMARY KEY, operation_id INTEGER, error_bucket_id INTEGER)")
 
     # Delete "code_coverage" table if exists, as it was the result of previous analysis and it will be recomputed
     cursor.execute("DROP TABLE IF EXISTS code_coverage")
@@ -169,6 +136,10 @@ def prepare_database(conn: sqlite3.Connection, count, total):
     # Create "cumulative_results" table
     cursor.execute('CREATE TABLE IF NOT EXISTS cumulative_results (id integer PRIMARY KEY, interaction_number integer, success_count integer, client_error_count integer, server_error_count integer, operation_coverage integer, unique_faults integer, branch_coverage real, line_coverage real, method_coverage real)')
 
+    # Delete and create "cumulative_results_time" table, with the same results sampled by time
+    cursor.execute('DROP TABLE IF EXISTS cumulative_results_time')
+    cursor.execute('CREATE TABLE cumulative_results_time (id integer PRIMARY KEY, elapsed_secs integer, interaction_number integer, success_count integer, client_error_count integer, server_error_count integer, operation_coverage integer, unique_faults integer, branch_coverage real, line_coverage real, method_coverage real)')
+
     # Commit changes
     conn.commit()
 
@@ -192,15 +163,11 @@ def get_operations(api):
                     id += 1
     return operations
 
-# Assign an operation ID to successful interactions
-def extract_operation_id_from_interaction(path, conn: sqlite3.Connection, count, total):
-
-    api = path.split('/')[-3]
-    cursor = conn.cursor()
-
-    # Get operations from specification and add regex
-    operations = get_operations(api)
-    for operation in operations:
+# Compile path regexes for the API operations, grouped by method (cached, so that all runs of an API share them)
+@functools.lru_cache(maxsize=None)
+def get_operation_matchers(api):
+    matchers = {}
+    for operation in get_operations(api):
         # Start from path
         regex = operation['path']
         # Replace all occurrences of {pathParameters} with [^/]*
@@ -214,7 +181,25 @@ def extract_operation_id_from_interaction(path, conn: sqlite3.Connection, count,
         if not regex.endswith('/'):
             regex += r'/'
         regex += '?'
-        operation['regex'] = regex
+        matchers.setdefault(operation['method'], []).append((operation['id'], re.compile(regex)))
+    return matchers
+
+# Find the first operation (in specification order) whose path regex matches the interaction path
+def match_operation(matchers, interaction_method, interaction_path):
+    for operation_id, regex in matchers.get(interaction_method, []):
+        match = regex.search(interaction_path)
+        if match != None and (match.span()[1] == len(interaction_path) or (match.span()[1] < len(interaction_path) and interaction_path[match.span()[1]] == '?')):
+            return operation_id
+    return None
+
+# Assign an operation ID to successful interactions
+def extract_operation_id_from_interaction(path, conn: sqlite3.Connection, count, total):
+
+    api = path.split('/')[-3]
+    cursor = conn.cursor()
+
+    # Get compiled operation regexes for the API
+    matchers = get_operation_matchers(api)
 
     # Collect interactions from database
     interactions = cursor.execute('SELECT id, request_method, request_path FROM interactions WHERE response_status_code >= 200 AND response_status_code < 300').fetchall()
@@ -222,6 +207,10 @@ def extract_operation_id_from_interaction(path, conn: sqlite3.Connection, count,
     # Limit to one log alert message for each API
     already_alerted = False
 
+    # Operation matched for each distinct method and path, and (interaction_id, operation_id) pairs to store
+    matched_paths = {}
+    matches = []
+
     # Process interactions
     for interaction in interactions:
         interaction_id = interaction[0]
@@ -233,20 +222,18 @@ def extract_operation_id_from_interaction(path, conn: sqlite3.Connection, count,
         interaction_path = interaction_path.split('?')[0] # TODO: use urllib to parse the path more robustly
         # Consider double slashes same as slashes
         interaction_path = interaction_path.replace('//', '/')
-        found_match = False
-        for operation in operations:
-            if interaction_method == operation['method']:
-                match = re.search(operation['regex'], interaction_path)
-                if match != None and (match.span()[1] == len(interaction_path) or (match.span()[1] < len(interaction_path) and interaction_path[match.span()[1]] == '?')):
-                    found_match = True
-                    operation_id = operation['id']
-                    cursor.execute('UPDATE interactions SET operation_id = ? WHERE id = ?', (operation_id, interaction_id))
-                    break
-        if not found_match:
+        key = (interaction_method, interaction_path)
+        if key not in matched_paths:
+            matched_paths[key] = match_operation(matchers, interaction_method, interaction_path)
+        operation_id = matched_paths[key]
+        if operation_id is not None:
+            matches.append((interaction_id, operation_id))
+        else:
             if api != 'languagetool': # Added this to avoid false positives from languagetool
                 if not already_alerted:
                     print(f" => [-WARN] ({count}/{total}) NO_PATH_MATCH: Could not find a path match with {interaction_method} {interaction_path}.")
                     already_alerted = True
+    cursor.executemany('INSERT INTO interaction_labels (interaction_id, operation_id) VALUES (?, ?) ON CONFLICT (interaction_id) DO UPDATE SET operation_id = excluded.operation_id', matches)
     conn.commit()
 
 # Jaccard similarity
@@ -285,78 +272,249 @@ def preprocess_response_body(api, response_body):
         response_body = response_body.replace('"', ' ').replace(':', ' ').replace('{', ' ').replace('}', ' ').replace('[', ' ').replace(']', ' ').replace(',', ' ')
     return response_body
 
+# Find the most similar bucket among those sharing at least one token with the response (ties go to the oldest bucket)
+def find_similar_bucket(api, words, buckets, token_index):
+    # Count tokens in common with each bucket, using the inverted index
+    intersections = {}
+    for word in words:
+        for bucket_id in token_index.get(word, ()):
+            intersections[bucket_id] = intersections.get(bucket_id, 0) + 1
+
+    candidate_bucket = None
+    candidate_similarity = 0
+    for bucket_id in sorted(intersections):
+        intersection = intersections[bucket_id]
+        similarity = float(intersection) / (len(words) + len(buckets[bucket_id]) - intersection)
+        if similarity >= JACCARD_SIMILARITY_THRESHOLDS[api] and similarity > candidate_similarity:
+            candidate_similarity = similarity
+            candidate_bucket = bucket_id
+    return candidate_bucket
+
+# Decode a stored body, which can be text (older runs) or bytes, possibly zlib-compressed
+def decode_body(content, encoding):
+    if isinstance(content, bytes):
+        if encoding == 'zlib':
+            content = zlib.decompress(content)
+        content = content.decode('utf-8', errors='replace')
+    return content
+
 # Bucket unique 5XX
 def bucket_unique_5xx(path, conn: sqlite3.Connection, count, total):
 
     api = path.split('/')[-3]
 
     cursor = conn.cursor()
-    interactions = cursor.execute('SELECT id, response_content FROM interactions WHERE response_status_code >= 500').fetchall()
+    # Runs recorded before body encodings were stored only have text bodies
+    has_encoding = cursor.execute("SELECT COUNT(1) FROM pragma_table_info('interactions') WHERE name = 'response_content_encoding'").fetchone()[0] > 0
+    encoding_column = 'response_content_encoding' if has_encoding else 'NULL'
+    interactions = cursor.execute(f'SELECT id, response_content, {encoding_column} FROM interactions WHERE response_status_code >= 500').fetchall()
 
-    bucket_count = 0
+    # Token sets of buckets (by bucket ID), first bucket for each token set, and buckets containing each token
     buckets = []
+    bucket_by_words = {}
+    token_index = {}
+    # Token sets of already preprocessed response bodies
+    words_by_body = {}
+    assignments = []
 
     for interaction in interactions:
         id = interaction[0]
-        response_body = preprocess_response_body(api, interaction[1])
-        words = response_body.split()
-        if len(words) == 0:
-            words = ['500']
-
-        candidate_bucket = None
-        candidate_similarity = 0
-        for bucket in buckets:
-            similarity = jaccard_similarity(words, bucket['words'])
-            if similarity >= JACCARD_SIMILARITY_THRESHOLDS[api] and similarity > candidate_similarity:
-                candidate_similarity = similarity
-                candidate_bucket = bucket
+        response_body = interaction[1]
+        body_key = (response_body, interaction[2])
+        words = words_by_body.get(body_key)
+        if words is None:
+            # Bodies are only decompressed the first time they are seen
+            words = preprocess_response_body(api, decode_body(response_body, interaction[2])).split()
+            if len(words) == 0:
+                words = ['500']
+            words = frozenset(words)
+            words_by_body[body_key] = words
+
+        # A bucket with the very same tokens has similarity 1, so no other bucket can beat it
+        candidate_bucket = bucket_by_words.get(words)
+        if candidate_bucket == None:
+            candidate_bucket = find_similar_bucket(api, words, buckets, token_index)
 
         if candidate_bucket == None:
-            candidate_bucket = {
-                'words': words,
-                'id': bucket_count
-            }
-            bucket_count += 1
-            buckets.append(candidate_bucket)
-        cursor.execute('UPDATE interactions SET error_bucket_id = ? WHERE id = ?', (candidate_bucket['id'], id))
+            candidate_bucket = len(buckets)
+            buckets.append(words)
+            bucket_by_words[words] = candidate_bucket
+            for word in words:
+                token_index.setdefault(word, []).append(candidate_bucket)
+        assignments.append((id, candidate_bucket))
+    cursor.executemany('INSERT INTO interaction_labels (interaction_id, error_bucket_id) VALUES (?, ?) ON CONFLICT (interaction_id) DO UPDATE SET error_bucket_id = excluded.error_bucket_id', assignments)
     conn.commit()
 
-# Compute code coverage on sample
-def compute_code_coverage_on_sample(path_to_csv):
-    code_coverage = {}
-    total_branch = 0
-    covered_branch = 0
-    total_line = 0
-    covered_line = 0
-    total_method = 0
-    covered_method = 0
+# Create empty code coverage counters
+def new_coverage_counters():
+    return {
+        'covered_branch': 0,
+        'total_branch': 0,
+        'covered_line': 0,
+        'total_line': 0,
+        'covered_method': 0,
+        'total_method': 0
+    }
+
+# Add the covered and total branches, lines and methods of a JaCoCo CSV row (split in items) to the counters
+def add_coverage_row(counters, items):
+    if '_COVERED' not in items[6] and '_MISSED' not in items[6]:
+        counters['covered_branch'] += int(items[6])
+        counters['total_branch'] += int(items[6]) + int(items[5])
+        counters['covered_line'] += int(items[8])
+        counters['total_line'] += int(items[8]) + int(items[7])
+        counters['covered_method'] += int(items[12])
+        counters['total_method'] += int(items[12]) + int(items[11])
+
+# Count covered and total branches, lines and methods in a JaCoCo CSV sample, reading it line by line
+def count_coverage_on_sample(path_to_csv):
+    counters = new_coverage_counters()
     with open(path_to_csv) as f:
-        lines = f.readlines()
-        for line in lines:
-            items = line.split(',')
-            if '_COVERED' not in items[6] and '_MISSED' not in items[6]:
-                covered_branch = covered_branch + int(items[6])
-                total_branch = total_branch + int(items[6]) + int(items[5])
-                covered_line = covered_line + int(items[8])
-                total_line = total_line + int(items[8]) + int(items[7])
-                covered_method = covered_method + int(items[12])
-                total_method = total_method + int(items[12]) + int(items[11])
-    code_coverage['branch'] = covered_branch / total_branch
-    code_coverage['line'] = covered_line / total_line
-    code_coverage['method'] = covered_method / total_method
+        for line in f:
+            add_coverage_row(counters, line.split(','))
+    return counters
+
+# Count covered and total branches, lines and methods of every sample in the coverage store of a run, reading it line
+# by line. Each row is a JaCoCo CSV row prefixed by the sample time. Incomplete or malformed rows (e.g., the last one,
+# if the collector was killed while appending) are skipped
+def count_coverage_on_store(path_to_store):
+    counters_by_time = {}
+    with open(path_to_store) as f:
+        for line in f:
+            if not line.endswith('\n'):
+                continue
+            sample_time, _, row = line.partition(',')
+            counters = counters_by_time.get(sample_time)
+            if counters is None:
+                counters = new_coverage_counters()
+            try:
+                add_coverage_row(counters, row.split(','))
+            except (IndexError, ValueError):
+                continue
+            counters_by_time[sample_time] = counters
+    counters_by_time.pop('SAMPLE_TIME', None)
+    return counters_by_time
+
+# Read the times of the samples listed in the index of the coverage store of a run
+def read_coverage_index(path_to_index):
+    sample_times = set()
+    try:
+        with open(path_to_index) as f:
+            for line in f:
+                fields = line.split()
+                if len(fields) == 3:
+                    sample_times.add(fields[0])
+    except OSError:
+        pass
+    return sample_times
+
+# Compute code coverage ratios from sample counters
+def coverage_from_counters(counters):
+    code_coverage = {}
+    code_coverage['branch'] = counters['covered_branch'] / counters['total_branch']
+    code_coverage['line'] = counters['covered_line'] / counters['total_line']
+    code_coverage['method'] = counters['covered_method'] / counters['total_method']
     return code_coverage
 
-# Compute code coverage on all samples
-def compute_code_coverage(path, conn: sqlite3.Connection):
+# Compute code coverage on sample
+def compute_code_coverage_on_sample(path_to_csv):
+    return coverage_from_counters(count_coverage_on_sample(path_to_csv))
+
+# Load the cache of sample counters of a run (empty if missing or unreadable). The cache is kept in the run directory, out
+# of the code coverage directory, which only holds what the run produced. A cache left in the code coverage directory by
+# a previous analysis is moved to the run directory
+def load_coverage_cache(path):
+    legacy_cache_path = f'{path}{common.CODE_COVERAGE_PATH}/{COVERAGE_CACHE_FILENAME}'
+    if os.path.exists(legacy_cache_path):
+        try:
+            os.replace(legacy_cache_path, f'{path}/{COVERAGE_CACHE_FILENAME}')
+        except OSError:
+            pass
+    try:
+        with open(f'{path}/{COVERAGE_CACHE_FILENAME}', 'r') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+# Store the cache of sample counters of a run (written to a temporary file first, so that it is never left truncated)
+def save_coverage_cache(path, cache):
+    cache_path = f'{path}/{COVERAGE_CACHE_FILENAME}'
+    try:
+        with open(cache_path + '.tmp', 'w') as f:
+            json.dump(cache, f)
+        os.replace(cache_path + '.tmp', cache_path)
+    except OSError as e:
+        print(f" => [-WARN] Could not store code coverage cache in {path}: {e}")
+
+# Compute code coverage on all samples. Samples without a report (e.g., deferred reports that could not be generated at
+# the end of the run) get their report generated first, if possible
+def compute_code_coverage(path, conn: sqlite3.Connection, generate_reports=True):
     cursor = conn.cursor()
-    # Get coverage files
-    files = os.listdir(path + common.CODE_COVERAGE_PATH)
-    # Do not consider EXEC files, only CSV files
-    for file in files:
-        if file.endswith('.csv'):
-            code_coverage = compute_code_coverage_on_sample(f'{path}/{common.CODE_COVERAGE_PATH}/{file}')
-            time = file.removeprefix('jacoco_').removesuffix('.csv').replace('.', ':')
-            cursor.execute('INSERT INTO code_coverage (sample_time, branch_coverage, line_coverage, method_coverage) VALUES (?, ?, ?, ?)', (time, code_coverage['branch'], code_coverage['line'], code_coverage['method']))
+    coverage_dir = path + common.CODE_COVERAGE_PATH
+
+    # Samples whose file is unchanged since the last analysis (same modification time and size) are taken from the cache
+    cache = load_coverage_cache(path)
+    counters_by_file = {}
+    files_to_parse = []
+    exec_samples = set()
+    csv_samples = set()
+    # Do not consider EXEC files, only CSV files: the coverage store of the run, and the per-sample files of runs
+    # collected by older images
+    for entry in os.scandir(coverage_dir):
+        if entry.name in (common.COVERAGE_SAMPLES_EXEC_FILENAME, common.COVERAGE_SAMPLES_INDEX_FILENAME):
+            continue
+        if entry.name.endswith('.exec'):
+            exec_samples.add(entry.name.removeprefix('jacoco_').removesuffix('.exec'))
+        elif entry.name.endswith('.csv'):
+            stat = entry.stat()
+            key = [stat.st_mtime_ns, stat.st_size]
+            cached = cache.get(entry.name)
+            if cached is not None and cached['key'] == key:
+                counters_by_file[entry.name] = cached['counters']
+            else:
+                files_to_parse.append((entry.name, key))
+
+    # Parse new or changed samples, in parallel in the shared pool unless runs are already analyzed in parallel processes
+    # (the store is a single file, so it is always parsed sequentially)
+    store_to_parse = [(file, key) for file, key in files_to_parse if file == common.COVERAGE_SAMPLES_CSV_FILENAME]
+    files_to_parse = [(file, key) for file, key in files_to_parse if file != common.COVERAGE_SAMPLES_CSV_FILENAME]
+    paths_to_parse = [f'{coverage_dir}/{file}' for file, _ in files_to_parse]
+    if PARSE_EXECUTOR is None or len(paths_to_parse) < 2:
+        parsed_counters = [count_coverage_on_sample(path_to_csv) for path_to_csv in paths_to_parse]
+    else:
+        parsed_counters = list(PARSE_EXECUTOR.map(count_coverage_on_sample, paths_to_parse, chunksize=16))
+    for file, key in store_to_parse:
+        files_to_parse.append((file, key))
+        parsed_counters.append(count_coverage_on_store(f'{coverage_dir}/{file}'))
+    for (file, key), counters in zip(files_to_parse, parsed_counters):
+        counters_by_file[file] = counters
+        cache[file] = {'key': key, 'counters': counters}
+
+    if len(files_to_parse) > 0 or len(cache) != len(counters_by_file):
+        save_coverage_cache(path, {file: cache[file] for file in counters_by_file})
+
+    # Merge the samples of the store and of per-sample files, by sample time
+    counters_by_time = dict(counters_by_file.pop(common.COVERAGE_SAMPLES_CSV_FILENAME, {}))
+    for file, counters in counters_by_file.items():
+        counters_by_time[file.removeprefix('jacoco_').removesuffix('.csv')] = counters
+    csv_samples.update(counters_by_time)
+
+    # With deferred coverage reports, some samples could have been dumped without generating their report
+    exec_samples.update(read_coverage_index(f'{coverage_dir}/{common.COVERAGE_SAMPLES_INDEX_FILENAME}'))
+    missing_reports = len(exec_samples.difference(csv_samples))
+    if missing_reports > 0 and generate_reports:
+        print(f" => [-INFO] Generating {missing_reports} missing code coverage report(s) of {path}.")
+        if common.generate_coverage_reports(path, get_analysis_workers() if ANALYSIS_MODE == 'sequential' else 1):
+            return compute_code_coverage(path, conn, generate_reports=False)
+    if missing_reports > 0:
+        print(f" => [-WARN] {missing_reports} code coverage sample(s) of {path} have no CSV report and are not considered.")
+
+    rows = []
+    for sample_time in sorted(counters_by_time):
+        code_coverage = coverage_from_counters(counters_by_time[sample_time])
+        time = sample_time.replace('.', ':')
+        rows.append((time, code_coverage['branch'], code_coverage['line'], code_coverage['method']))
+    cursor.executemany('INSERT INTO code_coverage (sample_time, branch_coverage, line_coverage, method_coverage) VALUES (?, ?, ?, ?)', rows)
     conn.commit()
 
 # Get final coverage
@@ -369,67 +527,163 @@ def get_final_coverage(conn: sqlite3.Connection):
     final_coverage['method'] = code_coverage[2]
     return final_coverage
 
-# Compute cumulative results in table
-def compute_cumulative_results(conn: sqlite3.Connection):
+# Find the code coverage sample closest in time to an epoch (on ties, the first stored sample wins, as in SQLite). Samples
+# are sorted by epoch and id, so the candidates are the first sample of the closest epoch at or after the given one, and
+# the first sample of the closest epoch before it (several samples can have the same epoch)
+def find_closest_coverage_sample(samples, sample_epochs, epoch):
+    position = bisect.bisect_left(sample_epochs, epoch)
+    candidates = []
+    if position < len(samples):
+        candidates.append(samples[position])
+    if position > 0:
+        candidates.append(samples[bisect.bisect_left(sample_epochs, sample_epochs[position - 1])])
+    closest = None
+    for sample in candidates:
+        candidate = (abs(sample[0] - epoch), sample[1], sample[2], sample[3], sample[4])
+        if closest is None or candidate[:2] < closest[:2]:
+            closest = candidate
+    return closest
+
+# Accumulate results over interactions (rows of id, response status code, operation id, error bucket id, request and
+# response timestamps), yielding each interaction with the counts of interactions, successes, client errors, server
+# errors, covered operations and unique faults up to it
+def accumulate_results(interactions):
+    successes = 0
+    client_failures = 0
+    server_failures = 0
+    covered_operations = set()
+    unique_faults = set()
+    for count, interaction in enumerate(interactions, start=1):
+        status_code = interaction[1]
+        if status_code is not None:
+            if 200 <= status_code < 300:
+                successes += 1
+            elif 400 <= status_code < 500:
+                client_failures += 1
+            elif 500 <= status_code < 600:
+                server_failures += 1
+        if interaction[2] is not None:
+            covered_operations.add(interaction[2])
+        if interaction[3] is not None:
+            unique_faults.add(interaction[3])
+        yield interaction, (count, successes, client_failures, server_failures, len(covered_operations), len(unique_faults))
+
+# Compute cumulative results in tables, every CUMULATIVE_SAMPLE_STEP interactions and every CUMULATIVE_TIME_STEP_SECS
+# seconds up to the end of the time budget (in minutes), and return the rows of both
+def compute_cumulative_results(conn: sqlite3.Connection, time_budget):
 
-    SAMPLE_STEP = 100
     cursor = conn.cursor()
 
-    #min_and_max_coverage_times = cursor.execute('SELECT MIN(sample_time), MAX(sample_time) FROM code_coverage').fetchone()
-    #min_and_max_request_times = cursor.execute('SELECT MIN(request_timestamp), MAX(response_timestamp) FROM interactions').fetchone()
-    #min_request_time = datetime.datetime.fromtimestamp(min_and_max_request_times[0]-5, datetime.timezone.utc).isoformat()
-    #max_request_time = datetime.datetime.fromtimestamp(min_and_max_request_times[1]-5, datetime.timezone.utc).isoformat()
-    #print(min_and_max_coverage_times[0], min_and_max_coverage_times[1], min_request_time, max_request_time)
+    # Load code coverage samples once, sorted by time, so that each step only needs a binary search
+    samples = cursor.execute('SELECT CAST(strftime("%s", sample_time) AS INTEGER) AS sample_epoch, id, branch_coverage, line_coverage, method_coverage FROM code_coverage ORDER BY sample_epoch, id').fetchall()
+    sample_epochs = [sample[0] for sample in samples]
 
-    i = SAMPLE_STEP
     upper_limit = cursor.execute('SELECT COUNT(1) FROM interactions').fetchone()[0]
+    query = 'SELECT i.id, i.response_status_code, l.operation_id, l.error_bucket_id, i.request_timestamp, i.response_timestamp FROM interactions i LEFT JOIN interaction_labels l ON l.interaction_id = i.id'
 
-    while i <= upper_limit:
-        successes = cursor.execute('SELECT COUNT(1) FROM interactions WHERE response_status_code >= 200 AND response_status_code < 300 AND id <= ?', (i,)).fetchone()[0]
-        client_failures = cursor.execute('SELECT COUNT(1) FROM interactions WHERE response_status_code >= 400 AND response_status_code < 500 AND id <= ?', (i,)).fetchone()[0]
-        server_failures = cursor.execute('SELECT COUNT(1) FROM interactions WHERE response_status_code >= 500 AND response_status_code < 600 AND id <= ?', (i,)).fetchone()[0]
-        operations_coverage = cursor.execute('SELECT COUNT(DISTINCT operation_id) FROM interactions WHERE operation_id NOT NULL AND id <= ?', (i,)).fetchone()[0]
-        unique_faults = cursor.execute('SELECT COUNT(DISTINCT error_bucket_id) FROM interactions WHERE error_bucket_id NOT NULL AND id <= ?', (i,)).fetchone()[0]
-        timestamps_of_interaction = cursor.execute('SELECT request_timestamp, response_timestamp FROM interactions WHERE id = ?', (i,)).fetchone()
-        average_timestamp = round((timestamps_of_interaction[0] + timestamps_of_interaction[1]) / 2)
-        time_of_ith_request = datetime.datetime.fromtimestamp(average_timestamp, datetime.timezone.utc)# - datetime.timedelta(hours=2)
-        string_time_of_ith_request = time_of_ith_request.isoformat()
-
-
-
-        #print(f"RANGE: {string_time_of_ith_request} - {string_time_minus_five}")
-
+    # Rows sampled every CUMULATIVE_SAMPLE_STEP interactions, read in id order (i.e., as their responses arrived)
+    rows = []
+    for interaction, counts in accumulate_results(cursor.execute(f'{query} WHERE i.id <= ? ORDER BY i.id', (upper_limit,))):
+        i = interaction[0]
+        if i % CUMULATIVE_SAMPLE_STEP != 0:
+            continue
 
-        row = cursor.execute('SELECT branch_coverage, line_coverage, method_coverage, ABS(strftime("%s", sample_time) - strftime("%s", ?)) AS time_distance FROM code_coverage ORDER BY time_distance LIMIT 1',
-                             (string_time_of_ith_request,)).fetchone()
+        average_timestamp = round((interaction[4] + interaction[5]) / 2)
+        row = find_closest_coverage_sample(samples, sample_epochs, average_timestamp)
 
-        branch_coverage = row[0]
-        line_coverage = row[1]
-        method_coverage = row[2]
+        branch_coverage = row[2]
+        line_coverage = row[3]
+        method_coverage = row[4]
 
-        if row[3] > 5:
+        if row[0] > 5:
             print(" => [ERROR] Code coverage sample too far away in time. ")
 
-        cursor.execute('INSERT INTO cumulative_results (interaction_number, success_count, client_error_count, server_error_count, operation_coverage, unique_faults, branch_coverage, line_coverage, method_coverage) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)', (i, successes, client_failures, server_failures, operations_coverage, unique_faults, branch_coverage, line_coverage, method_coverage))
-        i += SAMPLE_STEP
+        rows.append((i, *counts[1:], branch_coverage, line_coverage, method_coverage))
+
+    # Rows sampled every CUMULATIVE_TIME_STEP_SECS seconds since the first request, read in request order in a second
+    # pass. Each row holds the results of the interactions started before the step
+    time_rows = []
+    if CUMULATIVE_TIME_STEP_SECS > 0:
+        start_timestamp = cursor.execute('SELECT MIN(request_timestamp) FROM interactions').fetchone()[0]
+        end_time_step = time_budget * 60
+        next_time_step = CUMULATIVE_TIME_STEP_SECS
+        previous_counts = (0, 0, 0, 0, 0, 0)
+
+        def add_time_rows(until):
+            nonlocal next_time_step
+            while next_time_step <= until:
+                row = find_closest_coverage_sample(samples, sample_epochs, round(start_timestamp + next_time_step))
+                time_rows.append((next_time_step, *previous_counts, row[2], row[3], row[4]))
+                next_time_step += CUMULATIVE_TIME_STEP_SECS
+
+        if start_timestamp is not None and samples:
+            for interaction, counts in accumulate_results(cursor.execute(f'{query} ORDER BY i.request_timestamp, i.id')):
+                add_time_rows(interaction[4] - start_timestamp)
+                previous_counts = counts
+            # The steps after the last interaction, up to the end of the time budget, hold the final results
+            add_time_rows(end_time_step)
+
+    cursor.executemany('INSERT INTO cumulative_results (interaction_number, success_count, client_error_count, server_error_count, operation_coverage, unique_faults, branch_coverage, line_coverage, method_coverage) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)', rows)
+    cursor.executemany('INSERT INTO cumulative_results_time (elapsed_secs, interaction_number, success_count, client_error_count, server_error_count, operation_coverage, unique_faults, branch_coverage, line_coverage, method_coverage) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)', time_rows)
     conn.commit()
+    return rows, time_rows
+
+# Start the process pool shared by the runs analyzed in this process to parse coverage samples, unless runs are analyzed
+# in parallel processes, and shut it down once they are analyzed
+@contextlib.contextmanager
+def shared_parse_executor(workers):
+    global PARSE_EXECUTOR
+    if ANALYSIS_MODE == 'processes':
+        yield
+        return
+    PARSE_EXECUTOR = concurrent.futures.ProcessPoolExecutor(workers, mp_context=multiprocessing.get_context('spawn'))
+    try:
+        yield
+    finally:
+        PARSE_EXECUTOR.shutdown()
+        PARSE_EXECUTOR = None
 
 # Process runs
 def process_runs(paths):
-    threads = math.floor(multiprocessing.cpu_count() * 0.9)
-    count = 1
+    workers = get_analysis_workers()
     total = len(paths)
+    failed_runs = {}
 
-    with Progress() as progress:
+    with Progress() as progress, shared_parse_executor(workers):
         analysis_task = progress.add_task("Analyzing...", total=total)
 
-        with concurrent.futures.ThreadPoolExecutor(threads) as executor:
-            for path in paths:
-                if MULTITHREADING:
-                    executor.submit(process_run, path, count, total, progress, analysis_task)
-                else:
-                    process_run(path, count, total, progress, analysis_task)
-                count += 1
+        if ANALYSIS_MODE == 'sequential':
+            for count, path in enumerate(paths, start=1):
+                try:
+                    process_run(path, count, total)
+                except Exception as e:
+                    failed_runs[path] = e
+                    print(f" => [ERROR] ({count}/{total}) Analysis of {path} failed: {e!r}", flush=True)
+                progress.update(analysis_task, advance=1)
+        else:
+            if ANALYSIS_MODE == 'processes':
+                # Spawn (rather than fork) workers, as the progress bar runs a thread and redirects stdout in this process
+                executor = concurrent.futures.ProcessPoolExecutor(workers, mp_context=multiprocessing.get_context('spawn'))
+            else:
+                executor = concurrent.futures.ThreadPoolExecutor(workers)
+            with executor:
+                futures = {}
+                for count, path in enumerate(paths, start=1):
+                    futures[executor.submit(process_run, path, count, total)] = (count, path)
+                for future in concurrent.futures.as_completed(futures):
+                    count, path = futures[future]
+                    try:
+                        future.result()
+                    except Exception as e:
+                        failed_runs[path] = e
+                        print(f" => [ERROR] ({count}/{total}) Analysis of {path} failed: {e!r}", flush=True)
+                    progress.update(analysis_task, advance=1)
+
+        print(f"Analyzed {total - len(failed_runs)}/{total} runs successfully.")
+        if len(failed_runs) > 0:
+            print("WARNING: The following runs could not be analyzed and are not included in the aggregated results:")
+            for path in sorted(failed_runs):
+                print(f" => {path}")
 
         # Aggregate results from summaries
         '''summaries = collect_summaries()
@@ -443,23 +697,56 @@ def process_runs(paths):
                     aggregate_writer.writerow([api_info[2], api_info[3], api_info[4], d['interactions']['count'], d['interactions']['2XX'], d['interactions']['4XX'], d['interactions']['5XX'], d['interactions']['401'], d['interactions']['403'], d['interactions']['covered_operations'], d['interactions']['unique_5XX'], d['final_code_coverage']['branch'], d['final_code_coverage']['line'], d['final_code_coverage']['method']])
         print("Aggregated results saved to CSV file.")'''
 
-        minimums = extract_minimum_req_num()
-
-        with open(f"{common.RESTGYM_BASE_DIR}/results/aggregate_results_req_{datetime.datetime.now().strftime('%Y%m%dT%H.%M.%S')}.csv", mode='w') as aggregate_file:
+        export_aggregate_results(failed_runs)
+
+# Load into the catalog the cumulative results of processed runs that are missing there (e.g., runs processed before
+# the catalog existed), so that they are read from their database only once
+def backfill_cumulative_results():
+    cumulative_results = {}
+    for processed_run in catalog.get_runs_without_cumulative_results():
+        conn = sqlite3.connect(processed_run + '/' + common.DB_FILENAME)
+        rows = conn.execute('SELECT interaction_number, success_count, client_error_count, server_error_count, operation_coverage, unique_faults, branch_coverage, line_coverage, method_coverage FROM cumulative_results ORDER BY interaction_number').fetchall()
+        # Runs analyzed before cumulative results were sampled by time have no time rows
+        time_rows = []
+        if conn.execute("SELECT COUNT(1) FROM sqlite_master WHERE type = 'table' AND name = 'cumulative_results_time'").fetchone()[0] > 0:
+            time_rows = conn.execute('SELECT elapsed_secs, interaction_number, success_count, client_error_count, server_error_count, operation_coverage, unique_faults, branch_coverage, line_coverage, method_coverage FROM cumulative_results_time ORDER BY elapsed_secs').fetchall()
+        cumulative_results[processed_run] = (rows, time_rows)
+        conn.close()
+    if len(cumulative_results) > 0:
+        print(f" => [-INFO] Loaded cumulative results of {len(cumulative_results)} previously analyzed runs into the results catalog.")
+        catalog.store_cumulative_results(cumulative_results)
+
+# Export results of all processed runs (but failed ones) at the minimum number of interactions of their API, with the
+# area under each metric up to that point, from the cumulative results precomputed in the catalog
+def export_aggregate_results(failed_runs):
+    backfill_cumulative_results()
+    minimums = extract_minimum_req_num()
+    results = catalog.get_cumulative_results_at(minimums)
+
+    header = ['api', 'tool', 'run', 'interactions', '2XX', '4XX', '5XX', '401', '403', 'covered_operations', 'unique_5XX', 'branch_coverage', 'line_coverage', 'method_coverage', 'area_2XX', 'area_4XX', 'area_5XX', 'area_401', 'area_403', 'area_covered_operations', 'area_unique_5XX', 'area_branch_coverage', 'area_line_coverage', 'area_method_coverage']
+    rows = []
+    for processed_run in sorted(set(results).difference(failed_runs)):
+        api, tool, run = catalog.split_run_path(processed_run)
+        result = results[processed_run]
+        values = result[1::2]
+        areas = result[2::2]
+        rows.append([api, tool, run, result[0], values[0], values[1], values[2], "-", "-", values[3], values[4], values[5], values[6], values[7], areas[0], areas[1], areas[2], "-", "-", areas[3], areas[4], areas[5], areas[6], areas[7]])
+
+    timestamp = datetime.datetime.now().strftime('%Y%m%dT%H.%M.%S')
+    if 'csv' in AGGREGATE_EXPORT_FORMATS:
+        with open(f"{common.RESTGYM_BASE_DIR}/results/aggregate_results_req_{timestamp}.csv", mode='w') as aggregate_file:
             aggregate_writer = csv.writer(aggregate_file, delimiter=',', quotechar='"', quoting=csv.QUOTE_MINIMAL)
-            aggregate_writer.writerow(['api', 'tool', 'run', 'interactions', '2XX', '4XX', '5XX', '401', '403', 'covered_operations', 'unique_5XX', 'branch_coverage', 'line_coverage', 'method_coverage', 'area_2XX', 'area_4XX', 'area_5XX', 'area_401', 'area_403', 'area_covered_operations', 'area_unique_5XX', 'area_branch_coverage', 'area_line_coverage', 'area_method_coverage'])
-            for processed_run in collect_processed_runs():
-                api_info = processed_run.split('/')
-                conn = sqlite3.connect(processed_run + '/' + common.DB_FILENAME)
-                cursor = conn.cursor()
-                result = cursor.execute("SELECT * FROM cumulative_results WHERE interaction_number = ?", (minimums[api_info[2]],)).fetchone()
-                area = cursor.execute('SELECT SUM(success_count), SUM(client_error_count), SUM(server_error_count), SUM(operation_coverage), SUM(unique_faults), SUM(branch_coverage), SUM(line_coverage), SUM(method_coverage) FROM cumulative_results WHERE interaction_number <= ?', (minimums[api_info[2]],)).fetchone()
-                aggregate_writer.writerow([api_info[-3], api_info[-2], api_info[-1], result[1], result[2], result[3], result[4], "-", "-", result[5], result[6], result[7], result[8], result[9], area[0], area[1], area[2], "-", "-", area[3], area[4], area[5], area[6], area[7]])
-
+            aggregate_writer.writerow(header)
+            aggregate_writer.writerows(rows)
         print("Aggregated results saved to CSV file.")
+    if 'jsonl' in AGGREGATE_EXPORT_FORMATS:
+        with open(f"{common.RESTGYM_BASE_DIR}/results/aggregate_results_req_{timestamp}.jsonl", mode='w') as aggregate_file:
+            for row in rows:
+                aggregate_file.write(json.dumps(dict(zip(header, row))) + '\n')
+        print("Aggregated results saved to JSONL file.")
 
 # Process a single run (for parallelization purposes)
-def process_run(path, count, total, progress, task):
+def process_run(path, count, total):
 
     print(f" => [-INFO] ({count}/{total}) Analyzing run: {path}", flush=True)
 
@@ -478,7 +765,7 @@ def process_run(path, count, total, progress, task):
     # Get final code coverage
     final_code_coverage = get_final_coverage(conn)
     # Compute cumulative results
-    compute_cumulative_results(conn)
+    cumulative_results, cumulative_results_time = compute_cumulative_results(conn, parse_time_budget(f'{path}/time-budget.txt'))
 
     # Compile summary
     summary = {
@@ -489,10 +776,14 @@ def process_run(path, count, total, progress, task):
     # Write to file
     with open(path+'/summary.json', 'w', encoding='utf-8') as f:
         json.dump(summary, f, ensure_ascii=False, indent=4)
+    # Record the run and its cumulative results in the catalog, for the aggregated results
+    catalog.update_processed_run(path, interactions_stats['count'], final_code_coverage, cumulative_results, cumulative_results_time)
+
+    conn.close()
 
-    print(f" => [-END-] ({count}/{total}) Analysis completed.")
+    print(f" => [-END-] ({count}/{total}) Analysis completed.", flush=True)
 
-    progress.update(task, advance=1)
+    return summary
 
 # Main
 if __name__ == "__main__":
@@ -1,4 +1,6 @@
 import common
+import catalog
+import run_queue
 import socket
 import random
 import threading
@@ -7,12 +9,56 @@ import psutil
 import sys
 import os
 import yaml
+import json
+import itertools
+import gzip
+import shutil
+import docker
+import re
 from rich.progress import Progress
 
 
 MINIMUM_CPUS = 4
 MINIMUM_RAM_GB = 4
 TIME_BUDGET_MINS = 60
+BODY_STORAGE = 'text'
+BODY_STORAGES = ['text', 'blob', 'zlib']
+BODY_SIZE_CAP_KB = 0
+API_STARTUP_TIMEOUT_SECS = 300
+READINESS_POLL_INTERVAL_SECS = 1
+RESOURCE_POLL_INTERVAL_SECS = 5
+API_CONTAINER_CPUS = 8
+API_CONTAINER_RAM_GB = 16
+TOOL_CONTAINER_CPUS = 8
+TOOL_CONTAINER_RAM_GB = 16
+PIN_CPUS = False
+COVERAGE_REPORTS = 'live'
+COLLECTOR_STOP_TIMEOUT_SECS = 30
+PROXY_PID_FILE = '/tmp/store-interactions.pid'
+PROXY_STOP_TIMEOUT_SECS = 30
+MINIMUM_REQUESTS_PER_MIN = 130
+STALL_RESTART_MINS = 5
+STALL_GRACE_MINS = 2
+LIVE_METRICS_FILENAME = 'live-metrics.json'
+LIVE_METRICS_MAX_AGE_SECS = 60
+# Container logs are streamed to the logs folder of the run while it runs, and rotated when they exceed LOG_MAX_MB (0 for
+# no limit): rotated logs are compressed, and only the last LOG_BACKUPS of them are kept
+LOG_MAX_MB = 100
+LOG_BACKUPS = 3
+LOG_FLUSH_INTERVAL_SECS = 1
+LOG_CAPTURE_TIMEOUT_SECS = 30
+# Number of API containers started ahead of time on each host, for the next runs, so that they are ready when resources
+# for the run are available (0 to start the API container of each run when the run starts)
+API_POOL_SIZE = 0
+# Docker hosts that execute the runs (dicts with name, base_url and results_dir). By default, only the local Docker host
+DOCKER_HOSTS = []
+
+# Resources reserved by in-flight runs and pre-warmed API containers (reservation id -> {'resources', 'cpus', 'ram_gb',
+# 'api_cpuset', 'tool_cpuset', 'prewarm'}), guarded by RESERVATIONS_LOCK
+RESERVATIONS = {}
+RESERVATIONS_LOCK = threading.Lock()
+RESERVATION_IDS = itertools.count(1)
+RUN_COUNTER = itertools.count(1)
 
 
 # Read configuration form file to override default config
@@ -21,10 +67,30 @@ def read_config():
     with open(f'{common.RESTGYM_BASE_DIR}/restgym-config.yml') as stream:
         try:
             config = yaml.safe_load(stream)
-            global MINIMUM_CPUS, MINIMUM_RAM_GB, TIME_BUDGET_MINS
+            global MINIMUM_CPUS, MINIMUM_RAM_GB, TIME_BUDGET_MINS, BODY_STORAGE, BODY_SIZE_CAP_KB, API_STARTUP_TIMEOUT_SECS
+            global API_CONTAINER_CPUS, API_CONTAINER_RAM_GB, TOOL_CONTAINER_CPUS, TOOL_CONTAINER_RAM_GB, PIN_CPUS, COVERAGE_REPORTS
+            global MINIMUM_REQUESTS_PER_MIN, STALL_RESTART_MINS, DOCKER_HOSTS, LOG_MAX_MB, LOG_BACKUPS, API_POOL_SIZE
             MINIMUM_RAM_GB = int(config['minimum_ram_gb'])
             MINIMUM_CPUS = int(config['minimum_cpus'])
             TIME_BUDGET_MINS = int(config['time_budget_mins'])
+            BODY_STORAGE = str(config.get('body_storage', BODY_STORAGE))
+            if BODY_STORAGE not in BODY_STORAGES:
+                print(f"Unknown body storage '{BODY_STORAGE}' (valid values: {', '.join(BODY_STORAGES)}). Storing bodies as text.")
+                BODY_STORAGE = 'text'
+            BODY_SIZE_CAP_KB = int(config.get('body_size_cap_kb', BODY_SIZE_CAP_KB))
+            API_STARTUP_TIMEOUT_SECS = int(config.get('api_startup_timeout_secs', API_STARTUP_TIMEOUT_SECS))
+            API_CONTAINER_CPUS = int(config.get('api_container_cpus', API_CONTAINER_CPUS))
+            API_CONTAINER_RAM_GB = int(config.get('api_container_ram_gb', API_CONTAINER_RAM_GB))
+            TOOL_CONTAINER_CPUS = int(config.get('tool_container_cpus', TOOL_CONTAINER_CPUS))
+            TOOL_CONTAINER_RAM_GB = int(config.get('tool_container_ram_gb', TOOL_CONTAINER_RAM_GB))
+            PIN_CPUS = bool(config.get('pin_cpus', PIN_CPUS))
+            COVERAGE_REPORTS = str(config.get('coverage_reports', COVERAGE_REPORTS))
+            MINIMUM_REQUESTS_PER_MIN = int(config.get('minimum_requests_per_min', MINIMUM_REQUESTS_PER_MIN))
+            STALL_RESTART_MINS = int(config.get('stall_restart_mins', STALL_RESTART_MINS))
+            DOCKER_HOSTS = list(config.get('docker_hosts') or DOCKER_HOSTS)
+            LOG_MAX_MB = int(config.get('log_max_mb', LOG_MAX_MB))
+            LOG_BACKUPS = int(config.get('log_backups', LOG_BACKUPS))
+            API_POOL_SIZE = int(config.get('api_pool_size', API_POOL_SIZE))
 
         except yaml.YAMLError as exc:
             print("Could not parse RESTgym configuration file. Continuing with default configuration.")
@@ -57,36 +123,66 @@ def compute_remaining_runs(desired_runs):
     print("Enabled APIs: ", apis)
     tools = common.get_tools()
     print("Enabled tools: ", tools)
+    completed_runs = catalog.count_completed_runs()
     for api in apis:
         for tool in tools:
-            try:
-                base_dir = f"{common.RESTGYM_BASE_DIR}/results/{api}/{tool}"
-                subdirs = os.listdir(base_dir)
-                count = 0
-                for subdir in subdirs:
-                    if os.path.exists(f"{base_dir}/{subdir}/completed.txt"):
-                        count += 1
-                while count < desired_runs:
-                    remaining_runs.append({'api': api, 'tool': tool})
-                    count += 1
-            except:
-                for _ in range(desired_runs):
-                    remaining_runs.append({'api': api, 'tool': tool})
+            count = completed_runs.get((api, tool), 0)
+            while count < desired_runs:
+                remaining_runs.append({'api': api, 'tool': tool})
+                count += 1
     return remaining_runs
 
 
-# Verify Docker images have been built
-def check_docker_images(remaining_runs):
+# Connect to the Docker hosts that execute the runs. Hosts without a base URL, or with a unix:// one, are local: they
+# share the resources of this machine, which are measured before each run and reserved once for all of them. Results are
+# written by the containers to the results directory of their host, which must be the results folder of RESTgym, or a
+# shared storage mounted on it (e.g., NFS), so that all runs end up in the same results/<api>/<tool>/<run> layout
+def get_docker_hosts():
+    configured_hosts = DOCKER_HOSTS if len(DOCKER_HOSTS) > 0 else [{'name': 'local'}]
+    hosts = []
+    for configured_host in configured_hosts:
+        host = {
+            'name': str(configured_host.get('name', configured_host.get('base_url', 'local'))),
+            'local': configured_host.get('base_url') is None or str(configured_host['base_url']).startswith('unix://'),
+            'results_dir': str(configured_host.get('results_dir', f'{common.RESTGYM_BASE_DIR_HOST}/results/'))
+        }
+        # Reservations are shared by the hosts using the same resources
+        host['resources'] = 'local' if host['local'] else host['name']
+        if configured_host.get('base_url') is None:
+            host['client'] = common.DOCKER_CLIENT
+        else:
+            try:
+                host['client'] = docker.DockerClient(base_url=configured_host['base_url'])
+                info = host['client'].info()
+            except Exception as e:
+                print(f" => [-WARN] Could not connect to Docker host {host['name']} ({configured_host['base_url']}). Skipping it.\n{e}")
+                continue
+        if host['local']:
+            host['total_cpus'] = psutil.cpu_count()
+            host['total_ram_gb'] = psutil.virtual_memory().total / (1024 * 1024 * 1024)
+        else:
+            host['total_cpus'] = int(info['NCPU'])
+            host['total_ram_gb'] = int(info['MemTotal']) / (1024 * 1024 * 1024)
+        hosts.append(host)
+    return hosts
+
+
+# Verify Docker images have been built (an image is missing if any of the hosts misses it)
+def check_docker_images(remaining_runs, hosts):
     images = set()
     missing_images = []
     for remaining_run in remaining_runs:
         images.add(remaining_run['tool'])
         images.add(remaining_run['api'])
     for image in images:
-        try:
-            common.DOCKER_CLIENT.images.get(common.DOCKER_PREFIX + image)
-        except:
-            missing_images.append(image)
+        for host in hosts:
+            try:
+                host['client'].images.get(common.DOCKER_PREFIX + image)
+            except:
+                if len(hosts) > 1:
+                    print(f" => [-WARN] Docker image {common.DOCKER_PREFIX + image} not found on host {host['name']}.")
+                missing_images.append(image)
+                break
     return missing_images
 
 
@@ -115,8 +211,266 @@ def deep_check_resources():
     return True
 
 
-# Execute an experiment run
-def launch_run(api, tool, run_count, total_runs, progress, experiment_task):
+# Reserve the resources of the API and/or tool containers of a run on a host, if they fit next to the reservations of
+# in-flight runs on the same host (or on any local host). Returns the reservation, with the CPUs of each container if
+# pinned, or None if the run cannot be admitted yet. A run is always admitted when nothing but pre-warmed API containers
+# is reserved on the host. Pre-warmed API containers (prewarm) are only admitted if a tool container still fits next to
+# them, so that they never hold the resources that the runs they are warmed for need to start.
+def reserve_resources(host, parts=('api', 'tool'), prewarm=False):
+    sizes = {'api': (API_CONTAINER_CPUS, API_CONTAINER_RAM_GB), 'tool': (TOOL_CONTAINER_CPUS, TOOL_CONTAINER_RAM_GB)}
+    cpus = sum(sizes[part][0] for part in parts)
+    ram_gb = sum(sizes[part][1] for part in parts)
+    headroom_cpus, headroom_ram_gb = sizes['tool'] if prewarm else (0, 0)
+    total_cpus = host['total_cpus']
+    total_ram_gb = host['total_ram_gb']
+    with RESERVATIONS_LOCK:
+        host_reservations = [reservation for reservation in RESERVATIONS.values() if reservation['resources'] == host['resources']]
+        blocking_reservations = host_reservations if prewarm else [reservation for reservation in host_reservations if not reservation['prewarm']]
+        reserved_cpus = sum(reservation['cpus'] for reservation in host_reservations)
+        reserved_ram_gb = sum(reservation['ram_gb'] for reservation in host_reservations)
+        if len(blocking_reservations) > 0 and (reserved_cpus + cpus + headroom_cpus > total_cpus or reserved_ram_gb + ram_gb + headroom_ram_gb > total_ram_gb):
+            return None
+        cpuset = []
+        if PIN_CPUS:
+            pinned_cpus = set()
+            for reservation in host_reservations:
+                pinned_cpus.update((reservation['api_cpuset'] or []) + (reservation['tool_cpuset'] or []))
+            free_cpus = [cpu for cpu in range(total_cpus) if cpu not in pinned_cpus]
+            if len(free_cpus) < cpus:
+                if len(blocking_reservations) > 0:
+                    return None
+                free_cpus = list(range(total_cpus))
+            cpuset = free_cpus[:cpus]
+        reservation = {'id': next(RESERVATION_IDS), 'resources': host['resources'], 'cpus': cpus, 'ram_gb': ram_gb, 'api_cpuset': None, 'tool_cpuset': None, 'prewarm': prewarm}
+        if PIN_CPUS and 'api' in parts:
+            reservation['api_cpuset'] = cpuset[:API_CONTAINER_CPUS]
+            cpuset = cpuset[API_CONTAINER_CPUS:]
+        if PIN_CPUS and 'tool' in parts:
+            reservation['tool_cpuset'] = cpuset
+        RESERVATIONS[reservation['id']] = reservation
+        return reservation
+
+
+# Release the resources reserved by a run
+def release_resources(reservation):
+    with RESERVATIONS_LOCK:
+        RESERVATIONS.pop(reservation['id'], None)
+
+
+# Format a list of CPUs for Docker's cpuset option (None if the run is not pinned)
+def format_cpuset(cpus):
+    if cpus is None or len(cpus) == 0:
+        return None
+    return ','.join(str(cpu) for cpu in cpus)
+
+
+# Get the TCP ports listening in a container, reading the kernel socket tables (available in any image)
+def get_container_listening_ports(container):
+    exit_code, output = container.exec_run(['sh', '-c', 'cat /proc/net/tcp /proc/net/tcp6 2>/dev/null'])
+    ports = set()
+    for line in output.decode('utf-8', errors='replace').splitlines():
+        fields = line.split()
+        # Fields: sl, local_address (hex IP:hex port), rem_address, st (0A is LISTEN), ...
+        if len(fields) > 3 and fields[3] == '0A':
+            ports.add(int(fields[1].split(':')[-1], 16))
+    return ports
+
+
+# Wait until both the API (port 8080) and the proxy (port 9090) are listening in the API container
+def wait_for_api_ready(api_container, timeout):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        api_container.reload()
+        if api_container.status == 'exited':
+            raise Exception("Container exited")
+        if {8080, 9090}.issubset(get_container_listening_ports(api_container)):
+            return True
+        time.sleep(READINESS_POLL_INTERVAL_SECS)
+    return False
+
+
+# Stop the proxy of the API container cleanly (with SIGTERM), so that it stores its pending interactions and closes the
+# database, and wait for it to exit (a zombie process has exited too). Returns whether it exited within
+# PROXY_STOP_TIMEOUT_SECS (the proxy of images that do not record its pid cannot be stopped this way)
+def stop_proxy(api_container):
+    command = f'pid=$(cat {PROXY_PID_FILE}) && kill -TERM $pid && for i in $(seq {PROXY_STOP_TIMEOUT_SECS}); do if ! kill -0 $pid 2>/dev/null || grep -qs "^State:[[:space:]]*Z" /proc/$pid/status; then exit 0; fi; sleep 1; done; exit 1'
+    exit_code, _ = api_container.exec_run(['sh', '-c', command])
+    return exit_code == 0
+
+
+# Stop the code coverage collector of the API container, so that no sample is taken while the deferred reports are
+# generated: the collector stops after its current sample when the stop file appears, and then removes the file.
+# Returns whether the collector stopped within COLLECTOR_STOP_TIMEOUT_SECS
+def stop_coverage_collector(api_container):
+    stop_file = f'/results/$API/$TOOL/$RUN{common.CODE_COVERAGE_PATH}/{common.COVERAGE_COLLECTOR_STOP_FILENAME}'
+    command = f'mkdir -p $(dirname {stop_file}) && touch {stop_file} && for i in $(seq {COLLECTOR_STOP_TIMEOUT_SECS}); do [ -f {stop_file} ] || exit 0; sleep 1; done; exit 1'
+    exit_code, _ = api_container.exec_run(['sh', '-c', command])
+    return exit_code == 0
+
+
+# Generate the code coverage reports that were deferred during the run, in parallel in the API container (which has
+# the JDK, JaCoCo and the API classes). Only exec files without a report are processed
+def generate_deferred_coverage_reports(api_container):
+    command = f'java -cp /infrastructure/jacoco/org.jacoco.cli-0.8.7-nodeps.jar /infrastructure/jacoco/CoverageCollector.java report /api/classes/ /results/$API/$TOOL/$RUN{common.CODE_COVERAGE_PATH} {API_CONTAINER_CPUS}'
+    exit_code, output = api_container.exec_run(['sh', '-c', command])
+    return exit_code == 0, output.decode('utf-8', errors='replace')
+
+
+# Rotate a log file: compress it as the first backup (.1.gz), shifting the older ones, and drop those beyond LOG_BACKUPS
+def rotate_log(path):
+    if LOG_BACKUPS > 0:
+        for i in range(LOG_BACKUPS - 1, 0, -1):
+            if os.path.exists(f'{path}.{i}.gz'):
+                os.replace(f'{path}.{i}.gz', f'{path}.{i + 1}.gz')
+        with open(path, 'rb') as f_in, gzip.open(f'{path}.1.gz', 'wb') as f_out:
+            shutil.copyfileobj(f_in, f_out)
+    os.remove(path)
+
+
+# Stream the stdout or stderr of a container to a log file, chunk by chunk, until the container stops (or until the end
+# of the current logs, if not following). The file is flushed every LOG_FLUSH_INTERVAL_SECS, to be readable during the run
+def stream_container_log(container, path, stdout, follow=True):
+    try:
+        f = open(path, 'wb')
+        size = 0
+        last_flush = time.monotonic()
+        try:
+            for chunk in container.logs(stdout=stdout, stderr=not stdout, stream=True, follow=follow):
+                if LOG_MAX_MB > 0 and size > 0 and size + len(chunk) > LOG_MAX_MB * 1024 * 1024:
+                    f.close()
+                    rotate_log(path)
+                    f = open(path, 'wb')
+                    size = 0
+                f.write(chunk)
+                size += len(chunk)
+                if time.monotonic() - last_flush > LOG_FLUSH_INTERVAL_SECS:
+                    f.flush()
+                    last_flush = time.monotonic()
+        finally:
+            f.close()
+    except Exception as e:
+        print(f" => [-WARN] Could not capture the logs of container {container.name} to {os.path.basename(path)}: {e}")
+
+
+# Start streaming the stdout and stderr of a container to <name>-stdout.log and <name>-stderr.log in the logs folder of
+# the run, each in its own thread. Returns the threads
+def start_log_capture(container, results_path, name):
+    threads = []
+    for stdout, stream in [(True, 'stdout'), (False, 'stderr')]:
+        thread = threading.Thread(target=stream_container_log, args=(container, f'{results_path}{common.LOGS_PATH}/{name}-{stream}.log', stdout), daemon=True)
+        thread.start()
+        threads.append(thread)
+    return threads
+
+
+# Wait for the log streams of a stopped container to end
+def wait_for_log_capture(threads):
+    deadline = time.monotonic() + LOG_CAPTURE_TIMEOUT_SECS
+    for thread in threads:
+        thread.join(max(0, deadline - time.monotonic()))
+
+
+# Get the minimum request rate of a tool on an API (the same used to verify runs, where Schemathesis on Genome Nexus
+# only needs 50 requests per minute)
+def get_minimum_requests_per_min(api, tool):
+    if api == 'genome-nexus' and tool == 'schemathesis':
+        return min(50, MINIMUM_REQUESTS_PER_MIN)
+    return MINIMUM_REQUESTS_PER_MIN
+
+
+# Read the live metrics written by the proxy during a run (None if not available, e.g., with images built before live
+# metrics were introduced). Metrics that are not updated anymore are reported with a request rate of 0
+def read_live_metrics(results_path):
+    try:
+        with open(f'{results_path}/{LIVE_METRICS_FILENAME}') as f:
+            metrics = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if time.time() - metrics['timestamp'] > LIVE_METRICS_MAX_AGE_SECS:
+        metrics['requests_per_min'] = 0
+    return metrics
+
+
+# Create the directory of a new run of a tool on an API, named after the current time, and return its name. Workers of
+# different hosts may start runs of the same tool on the same API within the same second: the directory is created
+# atomically, and a numeric suffix is added if the name is taken, so that two attempts never share a run (or its
+# container names, which are derived from it)
+def create_run_directory(api, tool):
+    run = 'run-' + time.strftime('%Y%m%d-%H%M%S')
+    suffix = 1
+    while True:
+        name = run if suffix == 1 else f'{run}-{suffix}'
+        try:
+            os.makedirs(f'{common.RESTGYM_BASE_DIR}/results/{api}/{tool}/{name}', exist_ok=False, mode=0o777)
+            return name
+        except FileExistsError:
+            suffix += 1
+
+
+# Start a new attempt of a run: create its run directory and start its API container (without waiting for the API to
+# be ready). Returns the attempt (dict with run, results path, environment, API container and its log capture, and the
+# error that occurred, if any: 'images' if Docker images are missing, 'api' if the API container could not be started)
+def prepare_attempt(api, tool, host, entry_id, cpuset):
+    run = create_run_directory(api, tool)
+    results_path = f'{common.RESTGYM_BASE_DIR}/results/{api}/{tool}/{run}'
+    # On remote hosts, Docker assigns a free port itself
+    ports = {'9090/tcp': get_random_free_tcp_port() if host['local'] else None}
+    env = {
+        'API': api,
+        'TOOL': tool,
+        'RUN': run,
+        'TIME_BUDGET': TIME_BUDGET_MINS,
+        'HOST': 'localhost',
+        'BODY_STORAGE': BODY_STORAGE,
+        'BODY_SIZE_CAP': BODY_SIZE_CAP_KB * 1024,
+        'COVERAGE_REPORTS': COVERAGE_REPORTS
+    }
+    attempt = {'run': run, 'results_path': results_path, 'env': env, 'api_container': None, 'api_log_capture': [], 'error': None}
+
+    os.makedirs(f'{results_path}{common.LOGS_PATH}', exist_ok=True, mode=0o777)
+
+    with open(f'{results_path}/time-budget.txt', 'a') as f:
+        f.write(f'Time budget: {TIME_BUDGET_MINS} minutes.\n')
+
+    run_queue.start_attempt(entry_id, run)
+
+    # Verify Docker images have been built
+    try:
+        host['client'].images.get(common.DOCKER_PREFIX + api)
+        host['client'].images.get(common.DOCKER_PREFIX + tool)
+    except:
+        with open(f'{results_path}/errors.txt', 'a') as f:
+            f.write(
+                f"Docker image(s) not found for API ({api}) or tool ({tool}).\n\n")
+        attempt['error'] = 'images'
+        return attempt
+
+    # Start API
+    try:
+        attempt['api_container'] = host['client'].containers.run(
+            image=f'{common.DOCKER_PREFIX}{api}',
+            name=f'{common.DOCKER_PREFIX}-{api}-for-{tool}--{run}',
+            environment=env,
+            ports=ports,
+            volumes=[f"{host['results_dir'].rstrip('/')}/:/results/"],
+            mem_limit=f'{API_CONTAINER_RAM_GB}g',
+            nano_cpus=API_CONTAINER_CPUS * 1_000_000_000,
+            cpuset_cpus=format_cpuset(cpuset),
+            user=f'{os.getuid()}:{os.getgid()}',
+            detach=True
+        )
+        attempt['api_log_capture'] = start_log_capture(attempt['api_container'], results_path, api)
+
+    except Exception as e:
+        with open(f'{results_path}/errors.txt', 'a') as f:
+            f.write(f"Could not start API ({api}) container.\n{e}\n\n")
+        attempt['error'] = 'api'
+    return attempt
+
+
+# Execute an experiment run (started is set as soon as the tool is launched), on the CPUs of the reservation if pinned.
+# The first attempt uses the given pre-warmed attempt, if any, whose API container was started ahead of time
+def launch_run(api, tool, run_count, total_runs, progress, experiment_task, started, reservation, entry_id, host, prewarmed=None):
     attempts = 5
     successfully_completed = False
     progress.update(experiment_task, advance=1)
@@ -124,69 +478,41 @@ def launch_run(api, tool, run_count, total_runs, progress, experiment_task):
     while attempts > 0 and not successfully_completed:
 
         attempts -= 1
-        error_occurred = False
-        run = 'run-' + time.strftime('%Y%m%d-%H%M%S')
-        results_path = f'{common.RESTGYM_BASE_DIR}/results/{api}/{tool}/{run}'
-        ports = {'9090/tcp': get_random_free_tcp_port()}
-        env = {
-            'API': api,
-            'TOOL': tool,
-            'RUN': run,
-            'TIME_BUDGET': TIME_BUDGET_MINS,
-            'HOST': 'localhost'
-        }
-
-        os.makedirs(results_path, exist_ok=True, mode=0o777)
-        os.makedirs(f'{results_path}{common.LOGS_PATH}', exist_ok=True, mode=0o777)
+        if prewarmed is not None:
+            attempt, prewarmed = prewarmed, None
+        else:
+            attempt = prepare_attempt(api, tool, host, entry_id, reservation['api_cpuset'])
+        run = attempt['run']
+        results_path = attempt['results_path']
+        env = attempt['env']
+        api_container = attempt['api_container']
+        api_log_capture = attempt['api_log_capture']
+        error_occurred = attempt['error'] is not None
 
         message = 'START' if attempts == 4 else 'RETRY'
 
-        with open(f'{results_path}/time-budget.txt', 'a') as f:
-            f.write(f'Time budget: {TIME_BUDGET_MINS} minutes.\n')
-
-        print(f" => [{message}] ({run_count}/{total_runs}) Running {tool} on {api} ({run}).")
-        with open(f'{results_path}/started.txt', 'a') as f:
-            f.write(f'Run started on {time.ctime()}.\n')
+        print(f" => [{message}] ({run_count}/{total_runs}) Running {tool} on {api} ({run}){'' if host['local'] else ' on ' + host['name']}.")
+        if attempt['error'] == 'images':
+            print(
+                f" => [ERROR] ({run_count}/{total_runs}) Execution failed for {tool} on {api}. Missing Docker image(s). Have you built them?")
 
-        api_container_name = f'{common.DOCKER_PREFIX}-{api}-for-{tool}--{run}'
         tool_container_name = f'{common.DOCKER_PREFIX}-{tool}-for-{api}--{run}'
 
-        # Verify Docker images have been built
-        try:
-            common.DOCKER_CLIENT.images.get(common.DOCKER_PREFIX + remaining_run['api'])
-            common.DOCKER_CLIENT.images.get(common.DOCKER_PREFIX + remaining_run['tool'])
-        except:
-            print(
-                f" => [ERROR] ({run_count}/{total_runs}) Execution failed for {remaining_run['tool']} on {remaining_run['api']}. Missing Docker image(s). Have you built them?")
-            with open(f'{results_path}/errors.txt', 'a') as f:
-                f.write(
-                    f"Docker image(s) not found for API ({remaining_run['api']}) or tool ({remaining_run['tool']}).\n\n")
-            error_occurred = True
-
-        # Start API
+        # Wait for the API to start
         if not error_occurred:
             try:
-                api_container = common.DOCKER_CLIENT.containers.run(
-                    image=f'{common.DOCKER_PREFIX}{api}',
-                    name=api_container_name,
-                    environment=env,
-                    ports=ports,
-                    volumes=[f'{common.RESTGYM_BASE_DIR_HOST}/results/:/results/'],
-                    mem_limit='16g',
-                    nano_cpus=8_000_000_000,
-                    user=f'{os.getuid()}:{os.getgid()}',
-                    detach=True
-                )
-
+                if not wait_for_api_ready(api_container, API_STARTUP_TIMEOUT_SECS):
+                    print(f" => [-WARN] ({run_count}/{total_runs}) API {api} not listening after {API_STARTUP_TIMEOUT_SECS} seconds. Starting {tool} anyway.")
             except Exception as e:
+                print(f" => [ERROR] ({run_count}/{total_runs}) API container stopped while starting.")
                 with open(f'{results_path}/errors.txt', 'a') as f:
-                    f.write(f"Could not start API ({api}) container.\n{e}\n\n")
+                    f.write(f"API container not running while waiting for the API to start. Aborting.\n{e}\n\n")
+                try:
+                    api_container.stop()
+                except:
+                    pass
                 error_occurred = True
-
-        # Wait 45 seconds for the API to start
-        if not error_occurred:
-            time.sleep(45)
-        else:
+        if error_occurred:
             time.sleep(2)
 
         # Start tool
@@ -194,17 +520,24 @@ def launch_run(api, tool, run_count, total_runs, progress, experiment_task):
             # Get the host port assigned by docker
             api_container.reload()
             env['PORT'] = str(int(api_container.attrs['NetworkSettings']['Ports']['9090/tcp'][0]['HostPort']))
+            # The run starts with the tool (a pre-warmed API container may have been waiting for it)
+            with open(f'{results_path}/started.txt', 'a') as f:
+                f.write(f'Run started on {time.ctime()}.\n')
+            catalog.update_run(results_path, started=True, time_budget=TIME_BUDGET_MINS)
             try:
-                tool_container = common.DOCKER_CLIENT.containers.run(
+                tool_container = host['client'].containers.run(
                     image=f'{common.DOCKER_PREFIX}{tool}',
                     name=tool_container_name,
                     environment=env,
                     privileged=True,
                     network_mode='host',
-                    mem_limit='16gb',
-                    nano_cpus=8_000_000_000,
+                    mem_limit=f'{TOOL_CONTAINER_RAM_GB}g',
+                    nano_cpus=TOOL_CONTAINER_CPUS * 1_000_000_000,
+                    cpuset_cpus=format_cpuset(reservation['tool_cpuset']),
                     detach=True
                 )
+                tool_log_capture = start_log_capture(tool_container, results_path, tool)
+                started.set()
                 time.sleep(1)
             except Exception as e:
                 api_container.stop()
@@ -214,6 +547,10 @@ def launch_run(api, tool, run_count, total_runs, progress, experiment_task):
 
         # Perform a health check of containers each minute, for 60 times
         if not error_occurred:
+            minimum_requests_per_min = get_minimum_requests_per_min(api, tool)
+            required_requests = minimum_requests_per_min * TIME_BUDGET_MINS
+            peak_requests_per_min = 0
+            unreachable_minutes = 0
             for minute in range(1, TIME_BUDGET_MINS + 1):
                 time.sleep(60)
                 progress.update(experiment_task, advance=1)
@@ -247,15 +584,39 @@ def launch_run(api, tool, run_count, total_runs, progress, experiment_task):
                         pass
                     error_occurred = True
                     break
+                # Restart the run early if the tool stalled or is throttled so much that it cannot send the total number
+                # of requests required to pass the verification anymore, even at its peak rate for the rest of the time
+                # budget, for STALL_RESTART_MINS minutes in a row (unless this is the last attempt). Bursty tools that can
+                # still reach the total are not restarted
+                metrics = read_live_metrics(results_path)
+                if metrics is None or STALL_RESTART_MINS <= 0:
+                    continue
+                peak_requests_per_min = max(peak_requests_per_min, metrics['requests_per_min'])
+                if minute <= STALL_GRACE_MINS:
+                    continue
+                if metrics['requests'] + peak_requests_per_min * (TIME_BUDGET_MINS - minute) < required_requests:
+                    unreachable_minutes += 1
+                    print(f" => [-WARN] ({run_count}/{total_runs}) {tool} on {api} ({run}) sent {metrics['requests']} requests in {minute} minutes, and cannot reach {required_requests} at its peak rate ({peak_requests_per_min:.0f} requests per minute).")
+                else:
+                    unreachable_minutes = 0
+                if unreachable_minutes >= STALL_RESTART_MINS and attempts > 0:
+                    print(f" => [ERROR] ({run_count}/{total_runs}) {tool} on {api} ({run}) stalled. Restarting the run.")
+                    with open(f'{results_path}/errors.txt', 'a') as f:
+                        f.write(f"Tool cannot send {required_requests} requests within the time budget anymore ({metrics['requests']} requests at minute {minute}, peak rate {peak_requests_per_min:.0f} requests per minute). Aborting.\n{metrics}\n\n")
+                    for container in [tool_container, api_container]:
+                        try:
+                            container.stop()
+                        except:
+                            pass
+                    error_occurred = True
+                    break
 
         # Stop tool container
         if not error_occurred:
             try:
                 tool_container.stop()
                 tool_container.wait()
-                with open(f'{results_path}{common.LOGS_PATH}/{tool}-stdout.log', 'wb') as f_out, open(f'{results_path}{common.LOGS_PATH}/{tool}-stderr.log', 'wb') as f_err:
-                    f_out.write(tool_container.logs(stdout=True, stderr=False))
-                    f_err.write(tool_container.logs(stdout=False, stderr=True))
+                wait_for_log_capture(tool_log_capture)
                 tool_container.remove()
             except Exception as e:
                 error_occurred = True
@@ -266,18 +627,35 @@ def launch_run(api, tool, run_count, total_runs, progress, experiment_task):
                 except:
                     pass
 
-        # Wait 5 seconds to let the API container store the database
+        # Stop the proxy, so that the API container stores all the interactions in the database (or wait 5 seconds to let
+        # it store them, if the proxy cannot be stopped)
         if not error_occurred:
-            time.sleep(5)
+            try:
+                proxy_stopped = stop_proxy(api_container)
+            except Exception:
+                proxy_stopped = False
+            if not proxy_stopped:
+                time.sleep(5)
+
+        # Generate deferred code coverage reports, now that the time budget is over
+        if not error_occurred and COVERAGE_REPORTS == 'deferred':
+            try:
+                if not stop_coverage_collector(api_container):
+                    print(f" => [-WARN] ({run_count}/{total_runs}) The code coverage collector of {api} ({run}) did not stop in time. Generating reports anyway.")
+                reports_generated, output = generate_deferred_coverage_reports(api_container)
+                if not reports_generated:
+                    print(f" => [-WARN] ({run_count}/{total_runs}) Some code coverage reports could not be generated for {tool} on {api} ({run}).")
+                    with open(f'{results_path}{common.LOGS_PATH}/coverage-reports.log', 'w') as f:
+                        f.write(output)
+            except Exception as e:
+                print(f" => [-WARN] ({run_count}/{total_runs}) Could not generate code coverage reports for {tool} on {api} ({run}): {e}")
 
         # Stop API container
         if not error_occurred:
             try:
                 api_container.stop()
                 api_container.wait()
-                with open(f'{results_path}{common.LOGS_PATH}/{api}-stdout.log', 'wb') as f_out, open(f'{results_path}{common.LOGS_PATH}/{api}-stderr.log', 'wb') as f_err:
-                    f_out.write(api_container.logs(stdout=True, stderr=False))
-                    f_err.write(api_container.logs(stdout=False, stderr=True))
+                wait_for_log_capture(api_log_capture)
                 api_container.remove()
             except Exception as e:
                 error_occurred = True
@@ -289,12 +667,151 @@ def launch_run(api, tool, run_count, total_runs, progress, experiment_task):
             successfully_completed = True
             with open(f'{results_path}/completed.txt', 'a') as f:
                 f.write(f'Run completed on {time.ctime()}.\n')
+            catalog.update_run(results_path, completed=True)
             print(f" => [-END-] ({run_count}/{total_runs}) Run of {tool} on {api} ({run}) completed.")
         else:
             time.sleep(2)
             if attempts == 0:
                 print(f" => [ERROR] ({run_count}/{total_runs}) Run of {tool} on {api} ({run}) terminated with errors.")
 
+    return successfully_completed
+
+
+# Execute an experiment run, then record its outcome in the run queue and release its reserved resources (the API
+# containers of pre-warmed runs have their own reservation, the first one)
+def launch_run_and_release(api, tool, run_count, total_runs, progress, experiment_task, started, reservations, entry_id, host, prewarmed=None):
+    completed = False
+    reservation = {'api_cpuset': reservations[0]['api_cpuset'], 'tool_cpuset': reservations[-1]['tool_cpuset']}
+    try:
+        completed = launch_run(api, tool, run_count, total_runs, progress, experiment_task, started, reservation, entry_id, host, prewarmed)
+    finally:
+        run_queue.finish(entry_id, completed)
+        for run_reservation in reservations:
+            release_resources(run_reservation)
+        started.set()
+
+
+# Pull runs from the run queue and execute them on a Docker host, as long as its resources allow, until the queue is
+# empty. Each host has its own worker, so runs are spread across hosts as they free up. With API_POOL_SIZE > 0, the next
+# runs are leased ahead of time and their API containers are started on their own reserved (and pinned) resources, while
+# waiting for the resources of the tool (each run still gets a new API container, from the API image, so runs start
+# from the same state)
+def run_worker(host, owner, total_runs, progress, experiment_task):
+    threads = []
+    pool = []
+    notify_no_resources = True
+    while True:
+
+        # Pre-warm the API containers of the next runs, as long as their resources can be reserved
+        while len(pool) < API_POOL_SIZE:
+            api_reservation = reserve_resources(host, ['api'], prewarm=True)
+            if api_reservation is None:
+                break
+            if host['local'] and not deep_check_resources():
+                release_resources(api_reservation)
+                break
+            remaining_run = run_queue.lease(owner)
+            if remaining_run is None:
+                release_resources(api_reservation)
+                break
+            attempt = prepare_attempt(remaining_run['api'], remaining_run['tool'], host, remaining_run['id'], api_reservation['api_cpuset'])
+            print(f" => [-POOL] Pre-warming {remaining_run['api']} for {remaining_run['tool']} ({attempt['run']}){'' if host['local'] else ' on ' + host['name']}.")
+            pool.append((remaining_run, attempt, api_reservation))
+
+        # Stop until a run (or the tool of the oldest pre-warmed run) fits next to the reservations of in-flight runs, and
+        # resources are actually available (only measured on the local host, the others are only limited by their reservations)
+        reservation = reserve_resources(host, ['tool'] if len(pool) > 0 else ['api', 'tool'])
+        if reservation is not None and host['local'] and not deep_check_resources():
+            release_resources(reservation)
+            reservation = None
+        if reservation is None:
+            if run_queue.count_pending() == 0 and len(pool) == 0:
+                break
+            if notify_no_resources:
+                print(f" => [-WAIT] Waiting for system resources to be released on host {host['name']}.")
+                notify_no_resources = False
+            time.sleep(RESOURCE_POLL_INTERVAL_SECS)
+            continue
+        notify_no_resources = True
+
+        # Pick the oldest pre-warmed run, or a random run
+        prewarmed = None
+        reservations = [reservation]
+        if len(pool) > 0:
+            remaining_run, prewarmed, api_reservation = pool.pop(0)
+            with RESERVATIONS_LOCK:
+                api_reservation['prewarm'] = False
+            reservations = [api_reservation, reservation]
+        else:
+            remaining_run = run_queue.lease(owner)
+        if remaining_run is None:
+            release_resources(reservation)
+            break
+        run_count = next(RUN_COUNTER)
+
+        # Launch run in separate thread
+        started = threading.Event()
+        run_thread = threading.Thread(
+            target=launch_run_and_release,
+            args=(remaining_run['api'], remaining_run['tool'], run_count, total_runs, progress, experiment_task, started, reservations, remaining_run['id'], host, prewarmed)
+        )
+        run_thread.start()
+        threads.append(run_thread)
+
+        # If not last run, wait for the tool to be launched before measuring resources for the next run
+        if run_queue.count_pending() > 0 or len(pool) > 0:
+            started.wait()
+
+    # Wait for all the threads to complete
+    for t in threads:
+        t.join()
+
+
+# Renew the leases of the runs of this orchestrator, until it exits
+def renew_leases(owner):
+    while True:
+        time.sleep(run_queue.HEARTBEAT_INTERVAL_SECS)
+        run_queue.heartbeat(owner)
+
+
+# Stop and remove the containers left behind by interrupted orchestrators, i.e., those of runs that are not leased by an
+# alive orchestrator, storing their logs in the directory of their run. Interrupted runs that were not completed are
+# marked in their errors file (they are executed again, in a new run directory)
+def remove_orphaned_containers(expired_entries, hosts):
+    leased_runs = {entry['run'] for entry in run_queue.get_leased_runs().values()}
+    for entry in expired_entries:
+        results_path = f"{common.RESTGYM_BASE_DIR}/results/{entry['api']}/{entry['tool']}/{entry['run']}"
+        if entry['run'] is not None and not entry['completed'] and os.path.isdir(results_path):
+            with open(f'{results_path}/errors.txt', 'a') as f:
+                f.write(f"Run interrupted: the orchestrator stopped on {time.ctime()} or earlier. The run will be executed again.\n\n")
+    containers = []
+    for host in hosts:
+        try:
+            containers += host['client'].containers.list(all=True, filters={'name': common.DOCKER_PREFIX})
+        except Exception as e:
+            print(f" => [-WARN] Could not list the containers of host {host['name']}: {e}")
+    for container in containers:
+        match = re.fullmatch(f'{common.DOCKER_PREFIX}-(.+)-for-(.+)--(run-.+)', container.name)
+        if match is None or match.group(3) in leased_runs:
+            continue
+        image, other, run = match.groups()
+        # Containers are named after their image first: API containers after the API, tool containers after the tool
+        results_path = f'{common.RESTGYM_BASE_DIR}/results/{image}/{other}/{run}'
+        if not os.path.isdir(results_path):
+            results_path = f'{common.RESTGYM_BASE_DIR}/results/{other}/{image}/{run}'
+        print(f" => [-WARN] Removing orphaned container {container.name}.")
+        try:
+            container.stop()
+            # The whole logs of the container are stored next to the ones streamed during the run (which can have been
+            # rotated already), instead of overwriting them
+            if os.path.isdir(results_path):
+                os.makedirs(f'{results_path}{common.LOGS_PATH}', exist_ok=True, mode=0o777)
+                stream_container_log(container, f'{results_path}{common.LOGS_PATH}/{image}-stdout-recovered.log', True, follow=False)
+                stream_container_log(container, f'{results_path}{common.LOGS_PATH}/{image}-stderr-recovered.log', False, follow=False)
+            container.remove()
+        except Exception as e:
+            print(f" => [ERROR] Could not remove orphaned container {container.name}: {e}")
+
 
 # Main
 if __name__ == "__main__":
@@ -311,12 +828,28 @@ if __name__ == "__main__":
         print("Please specify a number in the range 1-20.")
         sys.exit(1)
 
+    hosts = get_docker_hosts()
+    if len(hosts) == 0:
+        print("No Docker host available. Please check the docker_hosts setting in the configuration file.")
+        sys.exit(1)
+    if len(DOCKER_HOSTS) > 0:
+        print(f"Docker hosts: {', '.join(host['name'] + ' (' + str(host['total_cpus']) + ' CPUs)' for host in hosts)}.")
+
+    # Recover the runs left behind by an interrupted orchestrator, before counting the completed runs
+    expired_entries = run_queue.recover()
+    remove_orphaned_containers(expired_entries, hosts)
+    if len(expired_entries) > 0:
+        print(f"Recovered {len(expired_entries)} runs of an interrupted experiment ({sum(entry['completed'] for entry in expired_entries)} of which completed).")
+    leased_runs = run_queue.get_leased_runs()
+    if len(leased_runs) > 0:
+        print(f"{len(leased_runs)} runs are in progress in another orchestrator ({', '.join(sorted(set(entry['owner'] for entry in leased_runs.values())))}). They are not planned again. If the orchestrator is not running anymore, its runs are recovered at the next launch after {run_queue.LEASE_TIMEOUT_SECS} seconds.")
+
     remaining_runs = compute_remaining_runs(desired_runs)
 
     # Uncomment next line to launch a manual subset of runs
     # remaining_runs = [{'api': 'market', 'tool': 'restler'}]
 
-    missing_images = check_docker_images(remaining_runs)
+    missing_images = check_docker_images(remaining_runs, hosts)
     if len(missing_images) > 0:
         filtered_remaining_runs = filter_runs_with_missing_images(remaining_runs, missing_images)
         print(
@@ -325,45 +858,23 @@ if __name__ == "__main__":
     else:
         print(f"Runs planned for execution: {len(remaining_runs)}.")
 
-    total_runs = len(remaining_runs)
-    run_count = 0
-
     input("Press ENTER to start the execution of the experiment (or CTRL+C to cancel)...")
 
+    # Runs are executed from the persistent run queue, so that an interrupted experiment resumes without lost or duplicate runs
+    total_runs = run_queue.plan(remaining_runs)
+    owner = run_queue.new_owner()
+    threading.Thread(target=renew_leases, args=(owner,), daemon=True).start()
+
     with Progress() as progress:
         experiment_task = progress.add_task("Running experiment...", total=total_runs*(TIME_BUDGET_MINS+1))
 
-        threads = []
-
-        while len(remaining_runs) > 0:
-
-            run_count += 1
-
-            # Pick random run
-            remaining_run = remaining_runs.pop(random.randrange(len(remaining_runs)))
-
-            # Stop until resources are available
-            notify_no_resources = True
-            while not deep_check_resources():
-                if notify_no_resources:
-                    print(f" => [-WAIT] ({run_count}/{total_runs}) Waiting for system resources to be released.")
-                    notify_no_resources = False
-                time.sleep(30)
-
-            # Launch run in separate thread
-            run_thread = threading.Thread(
-                target=launch_run,
-                args=(remaining_run['api'], remaining_run['tool'], run_count, total_runs, progress, experiment_task)
-            )
-            run_thread.start()
-            threads.append(run_thread)
-
-            # If not last run, wait 60 seconds before launching next
-            if len(remaining_runs) > 0:
-                time.sleep(60)
-
-        # Wait for all the threads to complete
-        for t in threads:
-            t.join()
+        # One worker per Docker host
+        workers = []
+        for host in hosts:
+            worker = threading.Thread(target=run_worker, args=(host, owner, total_runs, progress, experiment_task))
+            worker.start()
+            workers.append(worker)
+        for worker in workers:
+            worker.join()
 
         print("Execution completed.")
\ No newline at end of file
@@ -0,0 +1,155 @@
+import common
+import sqlite3
+import socket
+import os
+import time
+
+
+QUEUE_PATH = f'{common.RESTGYM_BASE_DIR}/results/run-queue.db'
+QUEUE_TIMEOUT_SECS = 60
+# Runs are leased by an orchestrator for LEASE_TIMEOUT_SECS seconds, and the lease is renewed every
+# HEARTBEAT_INTERVAL_SECS seconds while the orchestrator is alive. Runs whose lease expired were left behind by an
+# orchestrator that died, and are recovered by the next one
+LEASE_TIMEOUT_SECS = 120
+HEARTBEAT_INTERVAL_SECS = 30
+
+
+# Open the run queue, creating it if missing
+def open_queue():
+    os.makedirs(os.path.dirname(QUEUE_PATH), exist_ok=True)
+    conn = sqlite3.connect(QUEUE_PATH, timeout=QUEUE_TIMEOUT_SECS, isolation_level=None)
+    # The default (rollback) journal is used, as the results folder can be shared between hosts through NFS, where WAL is
+    # not supported
+    conn.execute('PRAGMA journal_mode=DELETE')
+    conn.execute('PRAGMA synchronous=FULL')
+    # Each entry is one run to execute, either pending, leased by an orchestrator, done, or failed after all attempts. The
+    # run directory of the current attempt is recorded when the attempt starts
+    conn.execute('CREATE TABLE IF NOT EXISTS queue (id INTEGER PRIMARY KEY, api TEXT, tool TEXT, state TEXT DEFAULT \'pending\', run TEXT, owner TEXT, lease_expires REAL, interruptions INTEGER DEFAULT 0, created REAL, updated REAL)')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_queue_state ON queue (state, api, tool)')
+    return conn
+
+
+# Execute a function within an immediate transaction, so that concurrent orchestrators never lease the same entry
+def transaction(function, *args):
+    conn = open_queue()
+    try:
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            result = function(conn, *args)
+            conn.execute('COMMIT')
+        except:
+            conn.execute('ROLLBACK')
+            raise
+        return result
+    finally:
+        conn.close()
+
+
+# Generate a unique identifier of this orchestrator, to be recorded in its leases
+def new_owner():
+    return f'{socket.gethostname()}:{os.getpid()}:{time.time():.0f}'
+
+
+# Check if the run of an entry was completed
+def is_completed(api, tool, run):
+    return run is not None and os.path.exists(f'{common.RESTGYM_BASE_DIR}/results/{api}/{tool}/{run}/completed.txt')
+
+
+# Release the expired leases, i.e., the runs left behind by interrupted orchestrators. Entries whose run was completed
+# anyway are marked as done, the others are put back in the queue. Returns the expired entries (dicts with id, api, tool,
+# run and whether the run was completed), so that the caller can clean up their containers
+def recover():
+    def recover_in_transaction(conn):
+        now = time.time()
+        expired = []
+        for entry_id, api, tool, run in conn.execute('SELECT id, api, tool, run FROM queue WHERE state = \'leased\' AND lease_expires < ?', (now,)).fetchall():
+            completed = is_completed(api, tool, run)
+            if completed:
+                conn.execute('UPDATE queue SET state = \'done\', lease_expires = NULL, updated = ? WHERE id = ?', (now, entry_id))
+            else:
+                conn.execute('UPDATE queue SET state = \'pending\', run = NULL, owner = NULL, lease_expires = NULL, interruptions = interruptions + 1, updated = ? WHERE id = ?', (now, entry_id))
+            expired.append({'id': entry_id, 'api': api, 'tool': tool, 'run': run, 'completed': completed})
+        return expired
+    return transaction(recover_in_transaction)
+
+
+# Get the runs currently leased by alive orchestrators (entry id -> dict with api, tool, run, owner and lease expiry)
+def get_leased_runs():
+    conn = open_queue()
+    leased = {entry_id: {'api': api, 'tool': tool, 'run': run, 'owner': owner, 'lease_expires': lease_expires}
+              for entry_id, api, tool, run, owner, lease_expires in conn.execute('SELECT id, api, tool, run, owner, lease_expires FROM queue WHERE state = \'leased\' AND lease_expires >= ?', (time.time(),))}
+    conn.close()
+    return leased
+
+
+# Plan the runs to execute (a list of dicts with api and tool, as computed from completed runs): the pending entries of
+# each API and tool are added or removed so that, together with the runs in progress, they match the plan. Returns the
+# number of pending entries
+def plan(remaining_runs):
+    def plan_in_transaction(conn):
+        now = time.time()
+        wanted = {}
+        for remaining_run in remaining_runs:
+            key = (remaining_run['api'], remaining_run['tool'])
+            wanted[key] = wanted.get(key, 0) + 1
+        # Runs in progress are not counted as completed yet, unless they completed just now
+        for api, tool, run in conn.execute('SELECT api, tool, run FROM queue WHERE state = \'leased\'').fetchall():
+            if wanted.get((api, tool), 0) > 0 and not is_completed(api, tool, run):
+                wanted[(api, tool)] -= 1
+        pending = {(api, tool): count for api, tool, count in conn.execute('SELECT api, tool, COUNT(1) FROM queue WHERE state = \'pending\' GROUP BY api, tool')}
+        for (api, tool), count in pending.items():
+            surplus = count - wanted.get((api, tool), 0)
+            if surplus > 0:
+                conn.execute('DELETE FROM queue WHERE id IN (SELECT id FROM queue WHERE state = \'pending\' AND api = ? AND tool = ? ORDER BY interruptions, id DESC LIMIT ?)', (api, tool, surplus))
+        for (api, tool), count in wanted.items():
+            missing = count - pending.get((api, tool), 0)
+            if missing > 0:
+                conn.executemany('INSERT INTO queue (api, tool, created, updated) VALUES (?, ?, ?, ?)', [(api, tool, now, now)] * missing)
+        return conn.execute('SELECT COUNT(1) FROM queue WHERE state = \'pending\'').fetchone()[0]
+    return transaction(plan_in_transaction)
+
+
+# Lease a random pending entry (dict with id, api and tool), or None if there are no pending entries
+def lease(owner):
+    def lease_in_transaction(conn):
+        row = conn.execute('SELECT id, api, tool FROM queue WHERE state = \'pending\' ORDER BY RANDOM() LIMIT 1').fetchone()
+        if row is None:
+            return None
+        now = time.time()
+        conn.execute('UPDATE queue SET state = \'leased\', owner = ?, lease_expires = ?, updated = ? WHERE id = ?', (owner, now + LEASE_TIMEOUT_SECS, now, row[0]))
+        return {'id': row[0], 'api': row[1], 'tool': row[2]}
+    return transaction(lease_in_transaction)
+
+
+# Count the pending entries
+def count_pending():
+    conn = open_queue()
+    count = conn.execute('SELECT COUNT(1) FROM queue WHERE state = \'pending\'').fetchone()[0]
+    conn.close()
+    return count
+
+
+# Record the run directory of a new attempt of a leased entry
+def start_attempt(entry_id, run):
+    conn = open_queue()
+    conn.execute('UPDATE queue SET run = ?, updated = ? WHERE id = ?', (run, time.time(), entry_id))
+    conn.close()
+
+
+# Renew the leases of an orchestrator. A failed renewal is only reported, as the lease is renewed again at the next heartbeat
+def heartbeat(owner):
+    try:
+        conn = open_queue()
+        try:
+            conn.execute('UPDATE queue SET lease_expires = ? WHERE state = \'leased\' AND owner = ?', (time.time() + LEASE_TIMEOUT_SECS, owner))
+        finally:
+            conn.close()
+    except sqlite3.Error as e:
+        print(f" => [-WARN] Could not renew run leases: {e}.")
+
+
+# Mark a leased entry as done or failed
+def finish(entry_id, completed):
+    conn = open_queue()
+    conn.execute('UPDATE queue SET state = ?, lease_expires = NULL, updated = ? WHERE id = ?', ('done' if completed else 'failed', time.time(), entry_id))
+    conn.close()
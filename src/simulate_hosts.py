@@ -0,0 +1,196 @@
+import common
+import catalog
+import run_queue
+import run
+import tempfile
+import itertools
+import threading
+import random
+import shutil
+import time
+import sys
+import os
+
+
+# Simulated campaign: runs of each API and tool, executed by two Docker hosts with SIMULATED_HOST_CPUS CPUs and
+# SIMULATED_HOST_RAM_GB GB of RAM each, where each run takes up to SIMULATED_RUN_SECS seconds
+SIMULATED_APIS = ['api-1', 'api-2']
+SIMULATED_TOOLS = ['tool-1', 'tool-2']
+SIMULATED_RUNS_PER_PAIR = 3
+SIMULATED_HOST_CPUS = 8
+SIMULATED_HOST_RAM_GB = 8
+SIMULATED_RUN_SECS = 0.5
+SIMULATION_TIMEOUT_SECS = 120
+
+# Runs in flight (entry id -> run), executed runs (host name and run path), and the problems found, guarded by
+# SIMULATION_LOCK
+IN_FLIGHT = {}
+EXECUTED = []
+PROBLEMS = []
+SIMULATION_LOCK = threading.Lock()
+
+
+# Fake Docker container, with no logs
+class FakeContainer:
+
+    def __init__(self, name, cpuset_cpus):
+        self.name = name
+        self.cpuset_cpus = cpuset_cpus
+
+    def logs(self, **kwargs):
+        return iter([])
+
+
+# Fake Docker client, where all images exist and containers are only recorded
+class FakeClient:
+
+    def __init__(self):
+        self.images = self
+        self.containers = self
+        self.started_containers = []
+
+    def get(self, image):
+        return image
+
+    def run(self, **kwargs):
+        container = FakeContainer(kwargs['name'], kwargs.get('cpuset_cpus'))
+        self.started_containers.append(container)
+        return container
+
+
+# Record a problem found by the simulation
+def report_problem(message):
+    with SIMULATION_LOCK:
+        PROBLEMS.append(message)
+    print(f" => [ERROR] {message}")
+
+
+# Check the reservations of in-flight runs and pre-warmed API containers: on each set of resources, they never exceed
+# the CPUs and RAM of the host, and no CPU is pinned twice
+def check_reservations(host):
+    with run.RESERVATIONS_LOCK:
+        reservations = [reservation for reservation in run.RESERVATIONS.values() if reservation['resources'] == host['resources']]
+    if sum(reservation['cpus'] for reservation in reservations) > host['total_cpus']:
+        report_problem(f"CPUs of {host['resources']} overbooked: {reservations}")
+    if sum(reservation['ram_gb'] for reservation in reservations) > host['total_ram_gb']:
+        report_problem(f"RAM of {host['resources']} overbooked: {reservations}")
+    pinned_cpus = [cpu for reservation in reservations for cpu in (reservation['api_cpuset'] or []) + (reservation['tool_cpuset'] or [])]
+    if len(pinned_cpus) != len(set(pinned_cpus)):
+        report_problem(f"CPUs of {host['resources']} pinned twice: {reservations}")
+
+
+# Simulated execution of a run, in place of run.launch_run: the API container is started (or taken from the pool) on the
+# fake client of the host, then the run holds its lease and reservations for a while, and completes
+def simulate_run(api, tool, run_count, total_runs, progress, experiment_task, started, reservation, entry_id, host, prewarmed=None):
+    attempt = prewarmed if prewarmed is not None else run.prepare_attempt(api, tool, host, entry_id, reservation['api_cpuset'])
+    with SIMULATION_LOCK:
+        executed_twice = entry_id in IN_FLIGHT
+        IN_FLIGHT[entry_id] = attempt['run']
+    if executed_twice:
+        report_problem(f"Entry {entry_id} executed twice at the same time")
+    if attempt['api_container'].cpuset_cpus != run.format_cpuset(reservation['api_cpuset']):
+        report_problem(f"API container of {attempt['run']} pinned to {attempt['api_container'].cpuset_cpus} instead of {reservation['api_cpuset']}")
+    leased = run_queue.get_leased_runs().get(entry_id)
+    if leased is None or leased['run'] != attempt['run']:
+        report_problem(f"Entry {entry_id} not leased for {attempt['run']} while running: {leased}")
+    print(f" => [START] ({run_count}/{total_runs}) Running {tool} on {api} ({attempt['run']}) on {host['name']}, API on CPUs {reservation['api_cpuset']}, tool on CPUs {reservation['tool_cpuset']}.")
+    started.set()
+    check_reservations(host)
+    time.sleep(random.uniform(SIMULATED_RUN_SECS / 2, SIMULATED_RUN_SECS))
+    with open(f"{attempt['results_path']}/completed.txt", 'a') as f:
+        f.write(f'Run completed on {time.ctime()}.\n')
+    with SIMULATION_LOCK:
+        IN_FLIGHT.pop(entry_id, None)
+        EXECUTED.append((host['name'], attempt['results_path']))
+    return True
+
+
+# Simulate a campaign on two hosts, either with their own resources (remote hosts) or sharing the resources of this
+# machine (local hosts, e.g., two contexts of the local Docker daemon). Returns whether no problem was found
+def simulate(shared_resources):
+    EXECUTED.clear()
+    problems = len(PROBLEMS)
+    run.RUN_COUNTER = itertools.count(1)
+    hosts = []
+    for name in ['host-a', 'host-b']:
+        hosts.append({
+            'name': name,
+            'local': shared_resources,
+            'results_dir': f'{common.RESTGYM_BASE_DIR}/results/',
+            'resources': 'local' if shared_resources else name,
+            'client': FakeClient(),
+            'total_cpus': SIMULATED_HOST_CPUS,
+            'total_ram_gb': SIMULATED_HOST_RAM_GB
+        })
+    print(f" => [-INFO] Simulating a campaign on two hosts {'sharing the resources of this machine' if shared_resources else 'with their own resources'}.")
+
+    # A run leased by an orchestrator that died is recovered and executed again
+    remaining_runs = [{'api': api, 'tool': tool} for api in SIMULATED_APIS for tool in SIMULATED_TOOLS for _ in range(SIMULATED_RUNS_PER_PAIR)]
+    run_queue.plan(remaining_runs)
+    dead_entry = run_queue.lease('dead-orchestrator')
+    run_queue.transaction(lambda conn: conn.execute('UPDATE queue SET lease_expires = 0 WHERE id = ?', (dead_entry['id'],)))
+    expired_entries = run_queue.recover()
+    if [entry['id'] for entry in expired_entries] != [dead_entry['id']] or expired_entries[0]['completed']:
+        report_problem(f"Expired lease not recovered: {expired_entries}")
+
+    total_runs = run_queue.plan(remaining_runs)
+    if total_runs != len(remaining_runs):
+        report_problem(f"{total_runs} runs planned instead of {len(remaining_runs)}")
+    owner = run_queue.new_owner()
+    # Workers that are still waiting after SIMULATION_TIMEOUT_SECS are stuck (e.g., on resources that were never released)
+    workers = [threading.Thread(target=run.run_worker, args=(host, owner, total_runs, None, None), daemon=True) for host in hosts]
+    for worker in workers:
+        worker.start()
+    deadline = time.monotonic() + SIMULATION_TIMEOUT_SECS
+    for worker in workers:
+        worker.join(max(0, deadline - time.monotonic()))
+    if any(worker.is_alive() for worker in workers):
+        report_problem(f"Workers still running after {SIMULATION_TIMEOUT_SECS} seconds, with reservations {run.RESERVATIONS}")
+        return False
+
+    # All runs were executed once, in their own run directory, and their resources were released
+    conn = run_queue.open_queue()
+    states = dict(conn.execute('SELECT state, COUNT(1) FROM queue GROUP BY state').fetchall())
+    conn.close()
+    if states != {'done': len(remaining_runs)}:
+        report_problem(f"Run queue not completed: {states}")
+    if len(EXECUTED) != len(remaining_runs) or len({results_path for _, results_path in EXECUTED}) != len(EXECUTED):
+        report_problem(f"{len(EXECUTED)} runs executed in {len({results_path for _, results_path in EXECUTED})} run directories, instead of {len(remaining_runs)}")
+    if len(run.RESERVATIONS) > 0:
+        report_problem(f"Resources not released: {run.RESERVATIONS}")
+    for host in hosts:
+        executed_runs = sum(1 for name, _ in EXECUTED if name == host['name'])
+        print(f" => [-INFO] Host {host['name']} executed {executed_runs} runs and started {len(host['client'].started_containers)} API containers.")
+        if executed_runs == 0:
+            report_problem(f"Host {host['name']} executed no runs")
+    return len(PROBLEMS) == problems
+
+
+# Main
+if __name__ == '__main__':
+    common.welcome()
+    print("This is the host simulation module. It will execute a simulated campaign with the run queue, the resource reservations and the workers of the run module, on two hosts with fake Docker clients.")
+    # The simulation uses its own results folder, run queue and catalog, and pins runs to CPUs with a pre-warmed API
+    # container per host
+    simulation_dir = tempfile.mkdtemp(prefix='restgym-simulation-')
+    common.RESTGYM_BASE_DIR = simulation_dir
+    run_queue.QUEUE_PATH = f'{simulation_dir}/results/run-queue.db'
+    catalog.CATALOG_PATH = f'{simulation_dir}/results/catalog.db'
+    run.launch_run = simulate_run
+    run.PIN_CPUS = True
+    run.API_POOL_SIZE = 1
+    run.API_CONTAINER_CPUS = run.TOOL_CONTAINER_CPUS = 2
+    run.API_CONTAINER_RAM_GB = run.TOOL_CONTAINER_RAM_GB = 2
+    run.RESOURCE_POLL_INTERVAL_SECS = 0.1
+    # Local hosts also measure the load of this machine for 10 seconds before each run, which the simulation skips
+    run.deep_check_resources = lambda: True
+    try:
+        for shared_resources in [False, True]:
+            successful = simulate(shared_resources)
+            if not successful:
+                break
+            os.remove(run_queue.QUEUE_PATH)
+    finally:
+        shutil.rmtree(simulation_dir, ignore_errors=True)
+    print("Simulation completed without problems." if successful else f"Simulation found {len(PROBLEMS)} problems.")
+    sys.exit(0 if successful else 1)